@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+"""
+Export the Real-ESRGAN x4plus network to ONNX for ONNX Runtime / TensorRT serving.
+Usage: python scripts/export_onnx.py [output_path]
+"""
+
+import copy
+import os
+import sys
+
+# Export the plain eager FP32 network, without runtime-only optimizations
+os.environ["UPSCALER_COMPILE"] = "0"
+os.environ["UPSCALER_CHANNELS_LAST"] = "0"
+
+import torch
+
+from upscaler.upscaler import get_upsampler
+
+
+def export_onnx(output_path: str = "rrdb_x4.onnx", opset: int = 17):
+    """Export RRDBNet with dynamic batch and spatial dimensions."""
+    # get_upsampler downloads the weights on first use
+    model = copy.deepcopy(get_upsampler().model).float().cpu().eval()
+
+    dummy = torch.rand(1, 3, 64, 64)
+    torch.onnx.export(
+        model,
+        dummy,
+        output_path,
+        opset_version=opset,
+        input_names=["input"],
+        output_names=["output"],
+        dynamic_axes={
+            "input": {0: "batch", 2: "height", 3: "width"},
+            "output": {0: "batch", 2: "height_x4", 3: "width_x4"},
+        },
+    )
+    print(f"Exported: {output_path} (opset {opset})")
+
+
+if __name__ == "__main__":
+    output_path = sys.argv[1] if len(sys.argv) > 1 else "rrdb_x4.onnx"
+    export_onnx(output_path)
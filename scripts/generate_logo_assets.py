@@ -4,22 +4,28 @@ Generate logo assets in multiple sizes from the source logo.
 Usage: python scripts/generate_logo_assets.py [source_logo_path]
 """
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from PIL import Image
 
 
-def create_logo_from_source(source_path: str, size: int) -> Image.Image:
-    """Load and resize source logo to target size."""
+def load_source_logo(source_path: str) -> Image.Image:
+    """Load and decode the source logo once."""
     img = Image.open(source_path)
     
     # Ensure RGBA mode for transparency
     if img.mode != 'RGBA':
         img = img.convert('RGBA')
     
+    # Force the decode now so worker threads only resize
+    img.load()
+    return img
+
+
+def create_logo_from_source(source: Image.Image, size: int) -> Image.Image:
+    """Resize the pre-loaded source logo to target size."""
     # Resize with high-quality resampling
-    resized = img.resize((size, size), Image.Resampling.LANCZOS)
-    
-    return resized
+    return source.resize((size, size), Image.Resampling.LANCZOS)
 
 
 def generate_assets(source_logo: str = "assets/logo/panda-logo.png"):
@@ -57,16 +63,24 @@ def generate_assets(source_logo: str = "assets/logo/panda-logo.png"):
         (512, 'panda-logo.png', static_logo_dir),  # Main logo in static
     ]
     
+    favicon_sizes = [16, 32, 48]
+    
+    # Resize every distinct size once, in parallel (Pillow releases the GIL while resizing)
+    source = load_source_logo(source_logo)
+    unique_sizes = sorted({size for size, _, _ in sizes} | set(favicon_sizes))
+    with ThreadPoolExecutor() as executor:
+        resized = dict(zip(unique_sizes, executor.map(
+            lambda size: create_logo_from_source(source, size), unique_sizes
+        )))
+    
     # Generate all sizes
     for size, filename, output_dir in sizes:
-        resized = create_logo_from_source(source_logo, size)
         output_path = output_dir / filename
-        resized.save(output_path)
+        resized[size].save(output_path)
         print(f"Created: {output_path} ({size}x{size})")
     
     # Create favicon.ico (multi-size ICO file)
-    favicon_sizes = [16, 32, 48]
-    favicon_images = [create_logo_from_source(source_logo, s) for s in favicon_sizes]
+    favicon_images = [resized[s] for s in favicon_sizes]
     favicon_path = static_logo_dir / 'favicon.ico'
     favicon_images[0].save(
         favicon_path,
@@ -2,7 +2,16 @@
 Image upscaler package using Real-ESRGAN.
 """
 
-from .app import app
 from .upscaler import get_upsampler, resize_to_target
 
 __all__ = ["app", "get_upsampler", "resize_to_target"]
+
+
+def __getattr__(name):
+    # Import the FastAPI app on first access, so the CLI does not pay for FastAPI
+    if name == "app":
+        from .app import app
+
+        globals()["app"] = app
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
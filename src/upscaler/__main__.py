@@ -2,9 +2,25 @@
 """
 Entry point for the image upscaler application.
 """
+import os
+
 import uvicorn
 
-from upscaler.app import app
+from upscaler.app import MAX_QUEUE, configure_log_level
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Keep per-request INFO logging off the hot path unless explicitly requested.
+    # Set through the environment so that spawned worker processes inherit it.
+    os.environ.setdefault("UPSCALER_LOG_LEVEL", "WARNING")
+    configure_log_level()
+    # uvicorn[standard] ships uvloop and httptools, which the default "auto" loop
+    # and http settings pick up. Each worker loads its own copy of the model, so a
+    # single worker is the right default when sharing one GPU.
+    uvicorn.run(
+        "upscaler.app:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=int(os.environ.get("UPSCALER_WORKERS", "1")),
+        # Reject excess connections with 503 before the batch queue fills up
+        limit_concurrency=MAX_QUEUE,
+    )
@@ -2,23 +2,282 @@
 Image upscaler web application using FastAPI and Real-ESRGAN.
 """
 
+import asyncio
+import hashlib
 import io
 import logging
+import os
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from pathlib import Path
+from typing import Annotated
 
-from fastapi import FastAPI, File, Form, HTTPException, UploadFile
-from fastapi.responses import FileResponse, StreamingResponse
+import numpy as np
+from fastapi import Depends, FastAPI, File, Form, HTTPException, Query, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from PIL import Image
+from pydantic import BaseModel, Field, ValidationError, model_validator
 
-from .upscaler import cm_to_pixels
-from .utils import upscale_image as upscale_image_util
+from .upscaler import cm_to_pixels, enhance_batch, fit_size, max_batch_size
+from .utils import (
+    draft_for_target,
+    finalize_image,
+    needs_upscaling,
+    prepare_image,
+    resize_image,
+)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Image Upscaler API", description="Upscale images using Real-ESRGAN")
+
+def configure_log_level() -> None:
+    """Apply UPSCALER_LOG_LEVEL to the upscaler loggers, when it is set."""
+    level = os.environ.get("UPSCALER_LOG_LEVEL")
+    if level:
+        logging.getLogger("upscaler").setLevel(level.upper())
+
+
+# Applied on import so that every uvicorn worker process picks up the level
+configure_log_level()
+
+# Output encoders, keyed by the "format" query parameter
+OUTPUT_FORMATS = {
+    # WebP encodes several times faster than PNG and produces much smaller files
+    "webp": ("WEBP", "image/webp", {"quality": 90, "method": 4}),
+    # Upscaled images compress poorly, so higher zlib levels burn CPU for few bytes
+    "png": ("PNG", "image/png", {"compress_level": 1}),
+}
+
+# Magic numbers of accepted upload formats: JPEG, PNG, GIF, BMP and TIFF.
+# WebP (RIFF....WEBP) is checked separately.
+IMAGE_SIGNATURES = (
+    b"\xff\xd8\xff",
+    b"\x89PNG\r\n\x1a\n",
+    b"GIF87a",
+    b"GIF89a",
+    b"BM",
+    b"II*\x00",
+    b"MM\x00*",
+)
+IMAGE_HEADER_SIZE = 12
+
+# Uploads larger than this are rejected with 413 before they are hashed or decoded
+MAX_UPLOAD_BYTES = int(os.environ.get("UPSCALER_MAX_UPLOAD_MB", "50")) * 1024 * 1024
+
+# Encoded results of recent requests, keyed by upload content hash and parameters,
+# so identical uploads (retries, popular images) skip the model entirely
+RESULT_CACHE_SIZE = int(os.environ.get("UPSCALER_CACHE_SIZE", "64"))
+# Total size of the cached results, since a single 10000x10000 output can take hundreds of MB
+RESULT_CACHE_BYTES = int(os.environ.get("UPSCALER_CACHE_MB", "256")) * 1024 * 1024
+_result_cache: OrderedDict[tuple, bytes] = OrderedDict()
+
+# Micro-batching of concurrent upscale requests
+BATCH_WINDOW = 0.01  # Seconds to wait for more requests to join a batch
+MAX_BATCH = 4  # Maximum number of images per model forward pass
+MAX_QUEUE = 32  # Bounded so that callers wait instead of piling up work
+
+_batch_queue: asyncio.Queue | None = None
+
+# Model state reported by /health: "starting" while warming up, "ready" or "failed".
+# Without warm-up the model is loaded lazily by the first request.
+_model_state = "ready"
+
+
+class UpscaleRequest(BaseModel):
+    """
+    Target dimensions of an upscale request, given either in pixels or in cm and DPI.
+
+    Out of range or incomplete parameters are rejected with 422 before the handler runs.
+    """
+
+    target_width: int | None = Field(None, ge=1, le=10000)
+    target_height: int | None = Field(None, ge=1, le=10000)
+    width_cm: float | None = Field(None, ge=0.1, le=400)
+    height_cm: float | None = Field(None, ge=0.1, le=400)
+    dpi: int | None = Field(None, ge=10, le=1200)
+
+    @model_validator(mode="after")
+    def check_mode(self):
+        """Require either both pixel dimensions or all three cm/dpi parameters."""
+        cm_params = (self.width_cm, self.height_cm, self.dpi)
+        if any(value is not None for value in cm_params):
+            if any(value is None for value in cm_params):
+                raise ValueError(
+                    "When using cm/dpi mode, all three parameters (width_cm, height_cm, dpi) are required"
+                )
+        elif self.target_width is None or self.target_height is None:
+            raise ValueError(
+                "Either provide target_width and target_height (in pixels) or width_cm, height_cm, and dpi"
+            )
+        return self
+
+
+def _upscale_request(
+    target_width: Annotated[int | None, Form()] = None,
+    target_height: Annotated[int | None, Form()] = None,
+    width_cm: Annotated[float | None, Form()] = None,
+    height_cm: Annotated[float | None, Form()] = None,
+    dpi: Annotated[int | None, Form()] = None,
+) -> UpscaleRequest:
+    """Validate the dimension form fields of an upscale request as a single model."""
+    try:
+        return UpscaleRequest(
+            target_width=target_width,
+            target_height=target_height,
+            width_cm=width_cm,
+            height_cm=height_cm,
+            dpi=dpi,
+        )
+    except ValidationError as e:
+        errors = [
+            {**error, "loc": ("body", *error["loc"])} for error in e.errors(include_url=False)
+        ]
+        raise RequestValidationError(errors) from e
+
+
+async def _batcher():
+    """Collect queued images into same-shape batches and run them through the model."""
+    loop = asyncio.get_running_loop()
+    while True:
+        pending = [await _batch_queue.get()]
+        deadline = loop.time() + BATCH_WINDOW
+        while len(pending) < MAX_BATCH:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                pending.append(await asyncio.wait_for(_batch_queue.get(), timeout))
+            except TimeoutError:
+                break
+
+        # Only images with identical dimensions can share a forward pass
+        groups: dict[tuple, list] = {}
+        for item in pending:
+            groups.setdefault(item[0].shape, []).append(item)
+
+        # Large images run alone, within the pixel budget of a stacked forward pass
+        chunks = []
+        for (height, width, _), group in groups.items():
+            per_call = max_batch_size(width, height)
+            chunks.extend(group[i : i + per_call] for i in range(0, len(group), per_call))
+
+        for chunk in chunks:
+            images, sizes, futures = zip(*chunk)
+            try:
+                outputs = await run_in_threadpool(enhance_batch, list(images), list(sizes))
+            except Exception as e:
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for future, output in zip(futures, outputs):
+                    if not future.done():
+                        future.set_result(output)
+
+
+async def _enhance(img_np: np.ndarray, size: tuple[int, int]) -> np.ndarray:
+    """Upscale a single image to size, sharing the forward pass with concurrent requests."""
+    if _batch_queue is None:
+        # Batcher is not running (e.g. the app was served without lifespan events)
+        return (await run_in_threadpool(enhance_batch, [img_np], [size]))[0]
+
+    future = asyncio.get_running_loop().create_future()
+    await _batch_queue.put((img_np, size, future))
+    return await future
+
+
+def _is_image_header(header: bytes) -> bool:
+    """Check the first bytes of an upload against known image signatures."""
+    if header.startswith(IMAGE_SIGNATURES):
+        return True
+    return header[:4] == b"RIFF" and header[8:12] == b"WEBP"
+
+
+def _hash_upload(file) -> bytes:
+    """Hash an uploaded file in chunks and rewind it for decoding."""
+    digest = hashlib.blake2b(digest_size=16)
+    for chunk in iter(lambda: file.read(1024 * 1024), b""):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.digest()
+
+
+def _decode_upload(file, target_width: int, target_height: int) -> Image.Image:
+    """
+    Decode an uploaded image, at a reduced JPEG scale when the target allows it.
+
+    Decodes straight from the spooled upload instead of copying it into memory,
+    forcing the full decode while the file is still open.
+    """
+    img = Image.open(file)
+    draft_for_target(img, target_width, target_height)
+    img.load()
+    return img
+
+
+def _encode_image(img: Image.Image, pil_format: str, save_options: dict) -> bytes:
+    """Encode the final image in the requested output format."""
+    img_byte_arr = io.BytesIO()
+    img.save(img_byte_arr, format=pil_format, **save_options)
+    return img_byte_arr.getvalue()
+
+
+def _cache_result(key: tuple, data: bytes) -> None:
+    """Store an encoded result, evicting the least recently used entries to stay within budget."""
+    if len(data) > RESULT_CACHE_BYTES:
+        return
+
+    _result_cache[key] = data
+    total_bytes = sum(map(len, _result_cache.values()))
+    while len(_result_cache) > RESULT_CACHE_SIZE or total_bytes > RESULT_CACHE_BYTES:
+        _, evicted = _result_cache.popitem(last=False)
+        total_bytes -= len(evicted)
+
+
+async def _warmup():
+    """Load the model and run a dummy forward pass so the first request is fast."""
+    global _model_state
+    try:
+        # Also triggers cuDNN algorithm selection and torch.compile, when enabled
+        dummy = np.zeros((64, 64, 3), dtype=np.uint8)
+        await run_in_threadpool(enhance_batch, [dummy])
+    except Exception as e:
+        logger.error("Model warm-up failed: %s", e)
+        _model_state = "failed"
+    else:
+        logger.info("Model warm-up complete")
+        _model_state = "ready"
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Warm up the model and run the request batcher for the lifetime of the application."""
+    global _batch_queue, _model_state
+    tasks = []
+    if os.environ.get("UPSCALER_WARMUP", "1") != "0":
+        _model_state = "starting"
+        tasks.append(asyncio.create_task(_warmup()))
+
+    _batch_queue = asyncio.Queue(maxsize=MAX_QUEUE)
+    tasks.append(asyncio.create_task(_batcher()))
+    try:
+        yield
+    finally:
+        for task in tasks:
+            task.cancel()
+        _batch_queue = None
+
+
+app = FastAPI(
+    title="Image Upscaler API",
+    description="Upscale images using Real-ESRGAN",
+    lifespan=lifespan,
+)
 
 # Get the templates and static directories
 TEMPLATES_DIR = Path(__file__).parent / "templates"
@@ -37,12 +296,9 @@ async def root():
 
 @app.post("/upscale")
 async def upscale_image(
+    params: Annotated[UpscaleRequest, Depends(_upscale_request)],
     image: UploadFile = File(...),
-    target_width: int = Form(None),
-    target_height: int = Form(None),
-    width_cm: float = Form(None),
-    height_cm: float = Form(None),
-    dpi: int = Form(None),
+    output_format: str = Query("webp", alias="format", pattern="^(webp|png)$"),
 ):
     """
     Upscale an image to target dimensions using Real-ESRGAN.
@@ -53,53 +309,33 @@ async def upscale_image(
     2. In centimeters and DPI using width_cm, height_cm, and dpi
 
     Args:
+        params: Target dimensions, validated by UpscaleRequest:
+            target_width: Target width in pixels (1-10000) - used if width_cm is not provided
+            target_height: Target height in pixels (1-10000) - used if height_cm is not provided
+            width_cm: Target width in centimeters (0.1-400) - alternative to target_width
+            height_cm: Target height in centimeters (0.1-400) - alternative to target_height
+            dpi: Dots per inch (10-1200) - required when using width_cm/height_cm
         image: Image file to upscale
-        target_width: Target width in pixels (1-10000) - used if width_cm is not provided
-        target_height: Target height in pixels (1-10000) - used if height_cm is not provided
-        width_cm: Target width in centimeters (0.1-400) - alternative to target_width
-        height_cm: Target height in centimeters (0.1-400) - alternative to target_height
-        dpi: Dots per inch (10-1200) - required when using width_cm/height_cm
+        output_format: Output image format, "webp" (default) or "png"
 
     Returns:
-        StreamingResponse with the upscaled image as PNG
+        StreamingResponse with the upscaled image
     """
-    # Determine which input method to use
-    if width_cm is not None or height_cm is not None or dpi is not None:
-        # Using cm/dpi mode
-        if width_cm is None or height_cm is None or dpi is None:
-            raise HTTPException(
-                status_code=400,
-                detail="When using cm/dpi mode, all three parameters (width_cm, height_cm, dpi) are required",
-            )
-
-        # Validate cm dimensions
-        if width_cm < 0.1 or width_cm > 400:
-            raise HTTPException(
-                status_code=400, detail="Width must be between 0.1 and 400 centimeters"
-            )
-        if height_cm < 0.1 or height_cm > 400:
-            raise HTTPException(
-                status_code=400, detail="Height must be between 0.1 and 400 centimeters"
-            )
-
-        # Validate DPI
-        if dpi < 10 or dpi > 1200:
-            raise HTTPException(status_code=400, detail="DPI must be between 10 and 1200")
-
+    if params.dpi is not None:
         # Convert cm to pixels
-        target_width, target_height = cm_to_pixels(width_cm, height_cm, dpi)
+        target_width, target_height = cm_to_pixels(params.width_cm, params.height_cm, params.dpi)
         logger.info(
-            f"Converted {width_cm}cm x {height_cm}cm @ {dpi}dpi to {target_width}px x {target_height}px"
+            "Converted %scm x %scm @ %sdpi to %spx x %spx",
+            params.width_cm,
+            params.height_cm,
+            params.dpi,
+            target_width,
+            target_height,
         )
     else:
-        # Using pixel mode
-        if target_width is None or target_height is None:
-            raise HTTPException(
-                status_code=400,
-                detail="Either provide target_width and target_height (in pixels) or width_cm, height_cm, and dpi",
-            )
+        target_width, target_height = params.target_width, params.target_height
 
-    # Validate pixel dimensions
+    # Large cm sizes at high DPI can still exceed the pixel limit
     if target_width < 1 or target_width > 10000:
         raise HTTPException(status_code=400, detail="Width must be between 1 and 10000 pixels")
     if target_height < 1 or target_height > 10000:
@@ -109,31 +345,63 @@ async def upscale_image(
     if not image.content_type.startswith("image/"):
         raise HTTPException(status_code=400, detail="File must be an image")
 
-    try:
-        # Read the uploaded image
-        contents = await image.read()
-        img = Image.open(io.BytesIO(contents))
-
-        # Upscale the image using shared utility function
-        final_img = upscale_image_util(img, target_width, target_height)
-
-        # Save to bytes buffer
-        img_byte_arr = io.BytesIO()
-        final_img.save(img_byte_arr, format="PNG")
-        img_byte_arr.seek(0)
-
-        return StreamingResponse(
-            img_byte_arr,
-            media_type="image/png",
-            headers={"Content-Disposition": f"attachment; filename=upscaled_{image.filename}"},
+    if image.size is not None and image.size > MAX_UPLOAD_BYTES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"File must not be larger than {MAX_UPLOAD_BYTES // (1024 * 1024)} MB",
         )
 
+    # Reject uploads whose leading bytes are not a known image signature
+    if not _is_image_header(image.file.read(IMAGE_HEADER_SIZE)):
+        raise HTTPException(status_code=400, detail="File must be an image")
+    image.file.seek(0)
+
+    pil_format, media_type, save_options = OUTPUT_FORMATS[output_format]
+    filename = f"upscaled_{Path(image.filename).stem}.{output_format}"
+    headers = {"Content-Disposition": f"attachment; filename={filename}"}
+
+    # Hashing, decoding, resizing and encoding run in the threadpool so the event
+    # loop stays free to batch concurrent requests and answer health checks
+    try:
+        digest = await run_in_threadpool(_hash_upload, image.file)
+        cache_key = (digest, target_width, target_height, output_format)
+        cached = _result_cache.get(cache_key)
+        if cached is not None:
+            _result_cache.move_to_end(cache_key)
+            logger.info("Returning cached result for identical upload")
+            return StreamingResponse(io.BytesIO(cached), media_type=media_type, headers=headers)
+
+        img = await run_in_threadpool(_decode_upload, image.file, target_width, target_height)
+
+        if needs_upscaling(img, target_width, target_height):
+            # Upscale the image, batching the model pass with concurrent requests
+            img_np = await run_in_threadpool(prepare_image, img)
+            size = fit_size(img.width, img.height, target_width, target_height)
+            output = await _enhance(img_np, size)
+            final_img = await run_in_threadpool(finalize_image, output)
+        else:
+            final_img = await run_in_threadpool(resize_image, img, target_width, target_height)
+
+        data = await run_in_threadpool(_encode_image, final_img, pil_format, save_options)
+        if RESULT_CACHE_SIZE > 0:
+            _cache_result(cache_key, data)
+
+        return StreamingResponse(io.BytesIO(data), media_type=media_type, headers=headers)
+
     except Exception as e:
-        logger.error(f"Error processing image: {str(e)}")
+        logger.error("Error processing image: %s", e)
         raise HTTPException(status_code=500, detail=f"Error processing image: {str(e)}")
 
 
 @app.get("/health")
 async def health_check():
-    """Health check endpoint"""
+    """Health check endpoint, reporting 503 until the model has warmed up"""
+    if _model_state == "starting":
+        return JSONResponse(
+            status_code=503, content={"status": "starting", "message": "Model is warming up"}
+        )
+    if _model_state == "failed":
+        return JSONResponse(
+            status_code=503, content={"status": "unhealthy", "message": "Model failed to load"}
+        )
     return {"status": "healthy", "message": "Image upscaler API is running"}
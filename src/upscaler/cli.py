@@ -3,97 +3,332 @@ Command-line interface for the image upscaler.
 """
 
 import argparse
+import io
 import logging
+import multiprocessing
+import os
 import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from itertools import chain, repeat
 from pathlib import Path
 
-from PIL import Image
+from PIL import Image, UnidentifiedImageError
 
-from .upscaler import cm_to_pixels
-from .utils import upscale_image
+from .upscaler import cm_to_pixels, get_upsampler
+from .utils import draft_for_target, upscale_image, upscale_image_batch
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
 logger = logging.getLogger(__name__)
 
+# Pipeline depth: images decoded ahead of inference and saves in flight behind it
+DECODE_WORKERS = 4
+ENCODE_WORKERS = 2
+
+# Maximum number of consecutive same-sized images upscaled in one model call
+INFERENCE_BATCH = 4
+
+# Per-file failures that are logged and skipped; anything else aborts the batch.
+# DecompressionBombError derives from Exception directly, so it is listed explicitly.
+PROCESSING_ERRORS = (
+    OSError,
+    UnidentifiedImageError,
+    Image.DecompressionBombError,
+    RuntimeError,
+    ValueError,
+)
+
+# Output encoding: JPEG for .jpg/.jpeg names, PNG otherwise. The "auto" format
+# keeps JPEG and PNG inputs in their own format and writes anything else as PNG.
+OUTPUT_SUFFIXES = {"png": ".png", "jpeg": ".jpg"}
+JPEG_SAVE_OPTIONS = {"quality": 92, "subsampling": 0, "optimize": False}
+DEFAULT_PNG_COMPRESS_LEVEL = 1  # zlib level 1 encodes ~4x faster than the default 6
+
+
+def _load_image(
+    file_path: Path, target_width: int, target_height: int, draft: bool = False
+) -> Image.Image:
+    """Open and fully decode an image file, at reduced JPEG scale when allowed."""
+    img = Image.open(file_path)
+    if draft:
+        draft_for_target(img, target_width, target_height)
+    else:
+        # Configure the JPEG decoder for RGB output at the original size, so
+        # quality is unchanged. This is a no-op for other formats.
+        img.draft("RGB", img.size)
+    img.load()
+    return img
+
+
+def _output_path(file_path: Path, output_format: str = "auto") -> Path:
+    """Build the output path for an upscaled image in the requested format."""
+    output_path = file_path.parent / f"{file_path.stem}_upscaled{file_path.suffix}"
+    if output_format != "auto":
+        return output_path.with_suffix(OUTPUT_SUFFIXES[output_format])
+    if output_path.suffix.lower() not in [".png", ".jpg", ".jpeg"]:
+        output_path = output_path.with_suffix(".png")
+    return output_path
+
+
+def _save_options(output_path: Path, png_compress_level: int) -> dict:
+    """Build the Image.save keyword arguments for an output path."""
+    if output_path.suffix.lower() in [".jpg", ".jpeg"]:
+        return {"format": "JPEG", **JPEG_SAVE_OPTIONS}
+    return {"format": "PNG", "compress_level": png_compress_level}
+
+
+def _part_path(output_path: Path) -> Path:
+    """Temporary path an output is written to before being renamed into place."""
+    return output_path.with_suffix(output_path.suffix + ".part")
+
+
+def _save_image(img: Image.Image, output_path: Path, **options) -> None:
+    """
+    Encode an image in memory and write it out with a single write.
+
+    The bytes go to a .part file that is renamed into place, so readers never see
+    a partially written output and slow filesystems get one large write instead
+    of many small encoder-sized ones.
+    """
+    buf = io.BytesIO()
+    img.save(buf, **options)
+    part_path = _part_path(output_path)
+    part_path.write_bytes(buf.getbuffer())
+    part_path.replace(output_path)
+
+
+def _init_worker(threads: int) -> None:
+    """Split the CPU inference threads between worker processes."""
+    os.environ.setdefault("UPSCALER_THREADS", str(threads))
+
+
+def _process_one(
+    file_path: Path,
+    target_width: int,
+    target_height: int,
+    png_compress_level: int,
+    output_format: str,
+    draft: bool = False,
+) -> bool:
+    """
+    Upscale and save a single file inside a worker process.
+
+    Returns:
+        True if the file was saved, False if it failed
+    """
+    logger.info("Processing: %s", file_path.name)
+    try:
+        img = _load_image(file_path, target_width, target_height, draft)
+        final_img = upscale_image(img, target_width, target_height)
+        output_path = _output_path(file_path, output_format)
+        _save_image(final_img, output_path, **_save_options(output_path, png_compress_level))
+    except PROCESSING_ERRORS as e:
+        logger.error("  Failed to process %s: %s", file_path.name, e)
+        return False
+    logger.info("  Saved to: %s", output_path)
+    return True
+
+
+def _upscale_in_processes(files: list[Path], workers: int, *options) -> int:
+    """
+    Fan files out to worker processes, each with its own model instance.
+
+    Args:
+        files: Files to process
+        workers: Number of worker processes
+        *options: Remaining _process_one arguments, shared by every file
+
+    Returns:
+        0 if at least one file succeeded, 1 otherwise
+    """
+    threads = max(1, (os.cpu_count() or 2) // 2 // workers)
+    # Spawn rather than fork: CUDA cannot be re-initialized in a forked child
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(threads,),
+    ) as executor:
+        shared = (repeat(option) for option in options)
+        results = list(executor.map(_process_one, files, *shared, chunksize=1))
+
+    success_count = sum(results)
+    logger.info("Successfully processed %d/%d image(s)", success_count, len(files))
+    return 0 if success_count > 0 else 1
+
 
 def upscale_images_batch(
     glob_pattern: str,
-    target_width: int = None,
-    target_height: int = None,
-    width_cm: float = None,
-    height_cm: float = None,
-    dpi: int = None,
+    target_width: int,
+    target_height: int,
+    png_compress_level: int = DEFAULT_PNG_COMPRESS_LEVEL,
+    output_format: str = "auto",
+    draft: bool = False,
+    workers: int = 1,
 ):
     """
     Upscale all images matching the glob pattern to target dimensions.
 
-    You can specify dimensions in two ways:
-    1. Directly in pixels using target_width and target_height
-    2. In centimeters and DPI using width_cm, height_cm, and dpi
-
     Args:
         glob_pattern: Glob pattern to match image files (e.g., "*.jpg", "images/*.png")
         target_width: Target width in pixels (1-10000)
         target_height: Target height in pixels (1-10000)
-        width_cm: Target width in centimeters (0.1-400)
-        height_cm: Target height in centimeters (0.1-400)
-        dpi: Dots per inch (10-1200)
+        png_compress_level: zlib compression level (0-9) for PNG outputs
+        output_format: "png", "jpeg" or "auto" to follow the input format
+        draft: Let libjpeg decode JPEGs at a reduced scale that still covers the target,
+            which is faster but slightly lowers quality
+        workers: Number of processes; above 1 each loads its own model and handles whole files
     """
-    # Determine which input method to use and convert if needed
-    if width_cm is not None or height_cm is not None or dpi is not None:
-        # Using cm/dpi mode
-        if width_cm is None or height_cm is None or dpi is None:
-            logger.error(
-                "When using cm/dpi mode, all three parameters (width_cm, height_cm, dpi) are required"
-            )
-            return 1
-
-        # Convert cm to pixels
-        target_width, target_height = cm_to_pixels(width_cm, height_cm, dpi)
-        logger.info(
-            f"Converted {width_cm}cm x {height_cm}cm @ {dpi}dpi to {target_width}px x {target_height}px"
-        )
-
-    # Find all matching files
+    # Sort the matches so processing and log order do not depend on the filesystem.
+    # Path.glob lists each directory in full anyway, and finishing the scan before
+    # writing anything keeps this run's outputs out of the inputs. Directories that
+    # match the pattern are skipped rather than reported as failures.
     current_dir = Path.cwd()
-    matching_files = list(current_dir.glob(glob_pattern))
+    matching_files = sorted(p for p in current_dir.glob(glob_pattern) if p.is_file())
 
     if not matching_files:
-        logger.error(f"No files found matching pattern: {glob_pattern}")
+        logger.error("No files found matching pattern: %s", glob_pattern)
         return 1
 
-    logger.info(f"Found {len(matching_files)} file(s) to process")
+    logger.info("Processing files matching: %s", glob_pattern)
 
-    # Process each file
+    if workers > 1:
+        options = (target_width, target_height, png_compress_level, output_format, draft)
+        return _upscale_in_processes(matching_files, min(workers, len(matching_files)), *options)
+
+    # Decode ahead and save behind on thread pools so inference never waits on disk
     success_count = 0
-    for file_path in matching_files:
+    file_count = 0
+    files = iter(matching_files)
+    load = partial(_load_image, target_width=target_width, target_height=target_height, draft=draft)
+    decodes = deque()
+    saves = deque()
+
+    def schedule_decode(file_path):
+        output_path = _output_path(file_path, output_format)
+        decodes.append((file_path, output_path, decode_pool.submit(load, file_path)))
+
+    def finish_save():
+        nonlocal success_count
+        file_path, output_path, future = saves.popleft()
         try:
-            logger.info(f"Processing: {file_path.name}")
+            future.result()
+            logger.info("  Saved to: %s", output_path)
+            success_count += 1
+        except PROCESSING_ERRORS as e:
+            logger.error("  Failed to process %s: %s", file_path.name, e)
+
+    with (
+        ThreadPoolExecutor(max_workers=DECODE_WORKERS) as decode_pool,
+        ThreadPoolExecutor(max_workers=ENCODE_WORKERS) as encode_pool,
+    ):
+        for file_path in files:
+            schedule_decode(file_path)
+            if len(decodes) == DECODE_WORKERS:
+                break
+
+        while decodes:
+            # Group consecutive files so same-sized images share one model call
+            batch = []
+            while decodes and len(batch) < INFERENCE_BATCH:
+                file_path, output_path, decoded = decodes.popleft()
+                file_count += 1
+                next_path = next(files, None)
+                if next_path is not None:
+                    schedule_decode(next_path)
+
+                logger.info("Processing: %s", file_path.name)
+                try:
+                    batch.append((file_path, output_path, decoded.result()))
+                except PROCESSING_ERRORS as e:
+                    logger.error("  Failed to process %s: %s", file_path.name, e)
+
+            try:
+                # Upscale the images using shared utility function
+                final_imgs = upscale_image_batch(
+                    [img for _, _, img in batch], target_width, target_height
+                )
+            except PROCESSING_ERRORS as e:
+                if len(batch) == 1:
+                    logger.error("  Failed to process %s: %s", batch[0][0].name, e)
+                    continue
+                # Retry one file at a time so only the files that fail on their own are lost
+                logger.warning("Batched upscaling failed (%s), retrying files one at a time", e)
+                final_imgs = []
+                for file_path, _, img in batch:
+                    try:
+                        final_imgs.append(upscale_image(img, target_width, target_height))
+                    except PROCESSING_ERRORS as e:
+                        logger.error("  Failed to process %s: %s", file_path.name, e)
+                        final_imgs.append(None)
+
+            # Save the results
+            for (file_path, output_path, _), final_img in zip(batch, final_imgs, strict=True):
+                if final_img is None:
+                    continue
+                options = _save_options(output_path, png_compress_level)
+                saves.append(
+                    (
+                        file_path,
+                        output_path,
+                        encode_pool.submit(_save_image, final_img, output_path, **options),
+                    )
+                )
+            while len(saves) > ENCODE_WORKERS:
+                finish_save()
+
+        while saves:
+            finish_save()
+
+    logger.info("Successfully processed %d/%d image(s)", success_count, file_count)
+    return 0 if success_count > 0 else 1
 
-            # Load image
-            img = Image.open(file_path)
 
-            # Upscale the image using shared utility function
-            final_img = upscale_image(img, target_width, target_height)
+def serve_batches(
+    glob_pattern: str | None,
+    target_width: int,
+    target_height: int,
+    png_compress_level: int = DEFAULT_PNG_COMPRESS_LEVEL,
+    output_format: str = "auto",
+    draft: bool = False,
+) -> int:
+    """
+    Run batches against a resident model, one glob pattern per line of stdin.
 
-            # Generate output filename
-            output_path = file_path.parent / f"{file_path.stem}_upscaled{file_path.suffix}"
-            if output_path.suffix.lower() not in [".png", ".jpg", ".jpeg"]:
-                output_path = output_path.with_suffix(".png")
+    The model is loaded once up front, so each batch skips the multi-second
+    startup of a fresh CLI invocation.
 
-            # Save the result
-            final_img.save(output_path, format="PNG")
-            logger.info(f"  Saved to: {output_path}")
+    Args:
+        glob_pattern: Optional pattern to process before reading stdin
+        target_width: Target width in pixels (1-10000)
+        target_height: Target height in pixels (1-10000)
+        png_compress_level: zlib compression level (0-9) for PNG outputs
+        output_format: "png", "jpeg" or "auto" to follow the input format
+        draft: Let libjpeg decode JPEGs at a reduced scale that still covers the target,
+            which is faster but slightly lowers quality
 
-            success_count += 1
+    Returns:
+        0 if every batch succeeded, 1 otherwise
+    """
+    get_upsampler()
+    logger.info("Model loaded, reading glob patterns from stdin")
 
-        except Exception as e:
-            logger.error(f"  Failed to process {file_path.name}: {str(e)}")
+    patterns = chain([glob_pattern] if glob_pattern else [], (line.strip() for line in sys.stdin))
+    result = 0
+    for pattern in patterns:
+        if not pattern:
             continue
-
-    logger.info(f"Successfully processed {success_count}/{len(matching_files)} image(s)")
-    return 0 if success_count > 0 else 1
+        try:
+            result |= upscale_images_batch(
+                pattern, target_width, target_height, png_compress_level, output_format, draft
+            )
+        except (NotImplementedError, ValueError, OSError) as e:
+            # Path.glob rejects absolute and malformed patterns; keep serving the next line
+            logger.error("Invalid glob pattern %s: %s", pattern, e)
+            result = 1
+    return result
 
 
 def main():
@@ -111,12 +346,16 @@ Examples:
 
   # Upscale a specific image with verbose logging
   upscaler-cli "photo.jpg" -w 3840 --height 2160 -v
+
+  # Keep the model loaded and upscale patterns as they arrive on stdin
+  printf 'a/*.jpg\nb/*.jpg\n' | upscaler-cli --serve -w 1920 --height 1080
         """,
     )
 
     parser.add_argument(
         "glob_pattern",
         type=str,
+        nargs="?",
         help="Glob pattern to match image files (e.g., '*.jpg', 'images/*.png')",
     )
 
@@ -153,6 +392,41 @@ Examples:
         help="Dots per inch (10-1200) - required when using --width-cm/--height-cm",
     )
 
+    parser.add_argument(
+        "--format",
+        choices=["auto", "png", "jpeg"],
+        default="auto",
+        help="Output format, 'auto' keeps JPEG and PNG inputs in their format (default: auto)",
+    )
+
+    parser.add_argument(
+        "--png-compress",
+        type=int,
+        default=DEFAULT_PNG_COMPRESS_LEVEL,
+        help=f"PNG compression level (0-9), default {DEFAULT_PNG_COMPRESS_LEVEL} favors speed",
+    )
+
+    parser.add_argument(
+        "--fast-draft",
+        dest="draft",
+        action="store_true",
+        help="Decode large JPEGs at a reduced scale that still covers the target; "
+        "faster, at slightly lower quality",
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes, each loading its own model (default: 1)",
+    )
+
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="Keep the model loaded and read one glob pattern per line from stdin",
+    )
+
     parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose logging")
 
     args = parser.parse_args()
@@ -175,6 +449,22 @@ Examples:
         logger.error("Cannot mix pixel-based and cm-based dimensions. Choose one mode.")
         return 1
 
+    if args.glob_pattern is None and not args.serve:
+        logger.error("A glob pattern is required unless --serve is used")
+        return 1
+
+    if args.workers < 1:
+        logger.error("Number of workers must be at least 1")
+        return 1
+
+    if args.workers > 1 and args.serve:
+        logger.error("--workers cannot be combined with --serve")
+        return 1
+
+    if not (0 <= args.png_compress <= 9):
+        logger.error("PNG compression level must be between 0 and 9")
+        return 1
+
     # Validate based on mode
     if using_cm:
         if args.width_cm is None or args.height_cm is None or args.dpi is None:
@@ -197,12 +487,15 @@ Examples:
             logger.error("DPI must be between 10 and 1200")
             return 1
 
-        # Run batch upscaling with cm/dpi
-        return upscale_images_batch(
-            args.glob_pattern,
-            width_cm=args.width_cm,
-            height_cm=args.height_cm,
-            dpi=args.dpi,
+        # Convert cm to pixels once for the whole run
+        target_width, target_height = cm_to_pixels(args.width_cm, args.height_cm, args.dpi)
+        logger.info(
+            "Converted %scm x %scm @ %sdpi to %spx x %spx",
+            args.width_cm,
+            args.height_cm,
+            args.dpi,
+            target_width,
+            target_height,
         )
     else:
         # Validate pixel dimensions
@@ -218,12 +511,13 @@ Examples:
             logger.error("Height must be between 1 and 10000 pixels")
             return 1
 
-        # Run batch upscaling with pixels
-        return upscale_images_batch(
-            args.glob_pattern,
-            target_width=args.width,
-            target_height=args.height,
-        )
+        target_width, target_height = args.width, args.height
+
+    # Run batch upscaling
+    batch_args = (target_width, target_height, args.png_compress, args.format, args.draft)
+    if args.serve:
+        return serve_batches(args.glob_pattern, *batch_args)
+    return upscale_images_batch(args.glob_pattern, *batch_args, args.workers)
 
 
 if __name__ == "__main__":
@@ -178,7 +178,11 @@ function initializeForm() {
 
       if (!response.ok) {
         const error = await response.json();
-        throw new Error(error.detail || "Failed to upscale image");
+        // Validation errors (422) carry a list of {loc, msg} entries
+        const detail = Array.isArray(error.detail)
+          ? error.detail.map((e) => e.msg).join("; ")
+          : error.detail;
+        throw new Error(detail || "Failed to upscale image");
       }
 
       const blob = await response.blob();
@@ -248,7 +252,7 @@ function downloadImage() {
     const url = URL.createObjectURL(uploadedImageData);
     const a = document.createElement("a");
     a.href = url;
-    a.download = "upscaled_image.png";
+    a.download = uploadedImageData.type === "image/webp" ? "upscaled_image.webp" : "upscaled_image.png";
     document.body.appendChild(a);
     a.click();
     document.body.removeChild(a);
@@ -7,10 +7,137 @@ import logging
 import numpy as np
 from PIL import Image
 
-from .upscaler import get_upsampler, resize_to_target
+from .upscaler import enhance_batch, fit_size, max_batch_size, resize_to_target
 
 logger = logging.getLogger(__name__)
 
+# Images above this many bytes are converted to arrays in L2-sized row bands
+CHUNKED_CONVERSION_BYTES = 8 * 1024 * 1024
+CHUNK_BYTES = 256 * 1024
+
+
+def needs_upscaling(img: Image.Image, target_width: int, target_height: int) -> bool:
+    """
+    Check whether fitting the image into the target dimensions enlarges it.
+
+    Args:
+        img: PIL Image to check
+        target_width: Target width in pixels
+        target_height: Target height in pixels
+
+    Returns:
+        True if the aspect-preserving fit is larger than the original image
+    """
+    return min(target_width / img.width, target_height / img.height) > 1
+
+
+def draft_for_target(img: Image.Image, target_width: int, target_height: int) -> None:
+    """
+    Let libjpeg decode a JPEG at 1/2, 1/4 or 1/8 scale when full resolution is not needed.
+
+    The reduced scale still covers the model input needed for the target (a quarter of
+    it, since Real-ESRGAN upscales 4x), or the target itself when no upscaling is needed.
+    Must be called before the image is loaded. This is a no-op for non-JPEG images.
+
+    Args:
+        img: Opened, not yet loaded, PIL Image
+        target_width: Target width in pixels
+        target_height: Target height in pixels
+    """
+    if needs_upscaling(img, target_width, target_height):
+        needed = max(target_width, target_height) // 4 + 32
+        requested = (needed, needed)
+    else:
+        requested = (target_width, target_height)
+
+    original_size = img.size
+    if img.draft("RGB", requested) is not None and img.size != original_size:
+        logger.info("Decoding JPEG at %s instead of %s", img.size, original_size)
+
+
+def resize_image(img: Image.Image, target_width: int, target_height: int) -> Image.Image:
+    """
+    Fit an image to the target dimensions without running Real-ESRGAN.
+
+    Used when the target is not larger than the original, where upscaling 4x
+    only to downscale afterwards would be wasted work.
+
+    Args:
+        img: PIL Image to resize (will be converted to RGB if needed)
+        target_width: Target width in pixels
+        target_height: Target height in pixels
+
+    Returns:
+        PIL Image resized to fit within target dimensions
+    """
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+
+    logger.info("Target is not larger than %s, skipping Real-ESRGAN", img.size)
+    return resize_to_target(img, target_width, target_height)
+
+
+def prepare_image(img: Image.Image) -> np.ndarray:
+    """
+    Convert an image to the RGB array layout expected by the upsampler.
+
+    Args:
+        img: PIL Image to convert (will be converted to RGB if needed)
+
+    Returns:
+        HxWx3 uint8 numpy array, read-only for images below CHUNKED_CONVERSION_BYTES
+    """
+    # Convert to RGB if necessary
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+
+    logger.info("Original image size: %s", img.size)
+
+    if img.width * img.height * 3 > CHUNKED_CONVERSION_BYTES:
+        return _pil_to_ndarray_chunked(img)
+
+    # Wrap the raw pixel bytes without the __array_interface__ round-trip.
+    # The array is read-only, which is fine since the upsampler only reads it.
+    return np.frombuffer(img.tobytes(), dtype=np.uint8).reshape(img.height, img.width, 3)
+
+
+def _pil_to_ndarray_chunked(img: Image.Image) -> np.ndarray:
+    """
+    Copy an RGB image into a preallocated array one row band at a time.
+
+    Each band fits in L2 cache, which avoids the giant buffer and chunk join
+    that a single tobytes() call needs for large images.
+
+    Args:
+        img: RGB PIL Image
+
+    Returns:
+        HxWx3 uint8 numpy array
+    """
+    width, height = img.size
+    rows_per_chunk = max(1, CHUNK_BYTES // (width * 3))
+    out = np.empty((height, width, 3), dtype=np.uint8)
+    for y0 in range(0, height, rows_per_chunk):
+        y1 = min(height, y0 + rows_per_chunk)
+        band = img.crop((0, y0, width, y1)).tobytes()
+        out[y0:y1] = np.frombuffer(band, dtype=np.uint8).reshape(y1 - y0, width, 3)
+    return out
+
+
+def finalize_image(output: np.ndarray) -> Image.Image:
+    """
+    Convert the upsampler output back to a PIL Image.
+
+    Args:
+        output: Upscaled HxWx3 uint8 numpy array, already at the final size
+
+    Returns:
+        PIL Image
+    """
+    final_img = Image.fromarray(output)
+    logger.info("Final image size: %s", final_img.size)
+    return final_img
+
 
 def upscale_image(img: Image.Image, target_width: int, target_height: int) -> Image.Image:
     """
@@ -18,7 +145,8 @@ def upscale_image(img: Image.Image, target_width: int, target_height: int) -> Im
 
     This function contains the core upscaling logic used by both the API and CLI.
     It converts the image to RGB, upscales it 4x using Real-ESRGAN, and then
-    resizes to the target dimensions while preserving aspect ratio.
+    resizes to the target dimensions while preserving aspect ratio. When the
+    target is not larger than the original the model pass is skipped.
 
     Args:
         img: PIL Image to upscale (will be converted to RGB if needed)
@@ -31,28 +159,51 @@ def upscale_image(img: Image.Image, target_width: int, target_height: int) -> Im
     Raises:
         Exception: If upscaling fails
     """
-    # Convert to RGB if necessary
-    if img.mode != "RGB":
-        img = img.convert("RGB")
+    return upscale_image_batch([img], target_width, target_height)[0]
 
-    logger.info(f"Original image size: {img.size}")
 
-    # Get upsampler
-    upsampler = get_upsampler()
-
-    # Convert PIL Image to numpy array
-    img_np = np.array(img)
+def upscale_image_batch(
+    imgs: list[Image.Image], target_width: int, target_height: int
+) -> list[Image.Image]:
+    """
+    Upscale several images to the same target dimensions.
 
-    # Upscale with Real-ESRGAN
-    logger.info("Starting upscaling process...")
-    output, _ = upsampler.enhance(img_np, outscale=4)
-    logger.info(f"Upscaled to: {output.shape[:2][::-1]}")
+    Images of the same size are stacked into a single Real-ESRGAN forward pass,
+    which amortizes the per-call overhead for batches of small images. Stacks
+    are capped at MAX_BATCH_PIXELS, so large images still run one at a time.
+    Images that do not need upscaling are resized without the model.
 
-    # Convert back to PIL Image
-    upscaled_img = Image.fromarray(output)
+    Args:
+        imgs: PIL Images to upscale (will be converted to RGB if needed)
+        target_width: Target width in pixels
+        target_height: Target height in pixels
 
-    # Resize to target dimensions while preserving aspect ratio
-    final_img = resize_to_target(upscaled_img, target_width, target_height)
-    logger.info(f"Final image size: {final_img.size}")
+    Returns:
+        PIL Images upscaled and resized to target dimensions, in input order
 
-    return final_img
+    Raises:
+        Exception: If upscaling fails
+    """
+    results = [None] * len(imgs)
+    groups = {}
+    for i, img in enumerate(imgs):
+        if needs_upscaling(img, target_width, target_height):
+            groups.setdefault(img.size, []).append(i)
+        else:
+            results[i] = resize_image(img, target_width, target_height)
+
+    for (width, height), group in groups.items():
+        size = fit_size(width, height, target_width, target_height)
+        per_call = max_batch_size(width, height)
+        for start in range(0, len(group), per_call):
+            indices = group[start : start + per_call]
+            arrays = [prepare_image(imgs[i]) for i in indices]
+
+            # Upscale with Real-ESRGAN, resizing to the target on the model's device
+            logger.info("Starting upscaling process for %d image(s)...", len(indices))
+            outputs = enhance_batch(arrays, sizes=[size] * len(indices))
+
+            for i, output in zip(indices, outputs, strict=True):
+                results[i] = finalize_image(output)
+
+    return results
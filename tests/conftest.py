@@ -2,14 +2,32 @@
 Shared test fixtures and configuration for pytest.
 """
 
+import functools
 import io
+import os
 from pathlib import Path
 
+import httpx
 import pytest
 from PIL import Image
 
+# Load the model on first use instead of at app startup, so the API tests that
+# never reach the model do not need it
+os.environ.setdefault("UPSCALER_WARMUP", "0")
 
-@pytest.fixture
+
+@pytest.fixture(scope="session")
+def client():
+    """Fixture that provides a TestClient with the app lifespan entered once per session."""
+    from fastapi.testclient import TestClient
+
+    from upscaler.app import app
+
+    with TestClient(app) as test_client:
+        yield test_client
+
+
+@pytest.fixture(scope="session")
 def test_image_path():
     """Fixture that provides the path to the panda test image."""
     return Path(__file__).parent / "assets" / "panda-low.jpeg"
@@ -22,7 +40,63 @@ def panda_test_image(test_image_path):
         return io.BytesIO(f.read())
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def panda_pil_image(test_image_path):
-    """Fixture that loads the panda test image as a PIL Image object."""
-    return Image.open(test_image_path)
+    """Fixture that decodes the panda test image once per session as a PIL Image object."""
+    with Image.open(test_image_path) as img:
+        img.load()
+        # Detach the pixels from the file so the handle is closed
+        return img.copy()
+
+
+@pytest.fixture(scope="session")
+def bmp_100_red_bytes():
+    """Fixture that encodes a 100x100 red BMP once per session, for requests rejected before decode."""
+    img = Image.new("RGB", (100, 100), color="red")
+    img_bytes = io.BytesIO()
+    img.save(img_bytes, format="BMP")
+    return img_bytes.getvalue()
+
+
+@pytest.fixture(scope="session")
+def bmp_upload(bmp_100_red_bytes):
+    """
+    Fixture that provides the multipart body of a BMP upload with the given form fields.
+
+    Each distinct set of fields is encoded once per session; pass the result to
+    client.post() as keyword arguments.
+    """
+
+    @functools.cache
+    def encode(**fields):
+        request = httpx.Request(
+            "POST",
+            "http://testserver/upscale",
+            files={"image": ("test.bmp", bmp_100_red_bytes, "image/bmp")},
+            data=fields,
+        )
+        return {
+            "content": request.read(),
+            "headers": {"content-type": request.headers["content-type"]},
+        }
+
+    return encode
+
+
+# Solid-color images shared by the resize tests; resizing never mutates its input
+@pytest.fixture(scope="session")
+def img_200x100_red():
+    """Fixture that provides a wide 200x100 red image."""
+    return Image.new("RGB", (200, 100), color="red")
+
+
+@pytest.fixture(scope="session")
+def img_100x200_blue():
+    """Fixture that provides a tall 100x200 blue image."""
+    return Image.new("RGB", (100, 200), color="blue")
+
+
+@pytest.fixture(scope="session")
+def img_100x100_green():
+    """Fixture that provides a square 100x100 green image."""
+    return Image.new("RGB", (100, 100), color="green")
@@ -2,27 +2,28 @@
 API integration tests for the upscaler application.
 """
 
-import sys
-from pathlib import Path
-
-# Add src to path for imports
-sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
-
+import asyncio
+import importlib
 import io
+import logging
+import time
+from unittest.mock import patch
 
+import httpx
+import numpy as np
 import pytest
-from fastapi.testclient import TestClient
 from PIL import Image
 
-from upscaler import app
+from upscaler.utils import resize_image
 
-client = TestClient(app)
+# The module itself, since the package attribute "app" is the FastAPI instance
+app_module = importlib.import_module("upscaler.app")
 
 
 class TestHealthEndpoint:
     """Tests for the health check endpoint."""
 
-    def test_health_check(self):
+    def test_health_check(self, client):
         """Test that health check returns 200 OK."""
         response = client.get("/health")
         assert response.status_code == 200
@@ -31,10 +32,27 @@ class TestHealthEndpoint:
         assert "message" in data
 
 
+class TestLogLevel:
+    """Tests for the UPSCALER_LOG_LEVEL setting."""
+
+    def test_log_level_from_environment(self, monkeypatch):
+        """Test that the level is read from the environment, as worker processes do on import."""
+        logger = logging.getLogger("upscaler")
+        original_level = logger.level
+        monkeypatch.setenv("UPSCALER_LOG_LEVEL", "error")
+
+        try:
+            app_module.configure_log_level()
+            assert logger.level == logging.ERROR
+        finally:
+            # setLevel also resets the cached levels of the child loggers
+            logger.setLevel(original_level)
+
+
 class TestRootEndpoint:
     """Tests for the root endpoint."""
 
-    def test_root_returns_html(self):
+    def test_root_returns_html(self, client):
         """Test that root endpoint returns HTML."""
         response = client.get("/")
         assert response.status_code == 200
@@ -46,67 +64,39 @@ class TestUpscaleEndpoint:
     """Tests for the upscale endpoint."""
 
     def create_test_image(self, width=100, height=100, color="red"):
-        """Helper to create a test image."""
+        """Helper to create encoded JPEG bytes for a test image."""
         img = Image.new("RGB", (width, height), color=color)
         img_bytes = io.BytesIO()
         img.save(img_bytes, format="JPEG")
-        img_bytes.seek(0)
-        return img_bytes
+        return img_bytes.getvalue()
 
-    def test_upscale_requires_image(self):
+    def test_upscale_requires_image(self, client):
         """Test that upscale endpoint requires an image."""
         response = client.post("/upscale", data={"target_width": 400, "target_height": 400})
         assert response.status_code == 422  # Unprocessable Entity
 
-    def test_upscale_requires_dimensions(self):
+    def test_upscale_requires_dimensions(self, client, bmp_upload):
         """Test that upscale endpoint requires dimensions."""
-        img_bytes = self.create_test_image()
-        response = client.post("/upscale", files={"image": ("test.jpg", img_bytes, "image/jpeg")})
-        assert response.status_code == 400  # Bad Request - no dimensions provided
+        response = client.post("/upscale", **bmp_upload())
+        assert response.status_code == 422  # no dimensions provided
 
-    def test_upscale_validates_width_range(self):
+    @pytest.mark.parametrize("target_width", [0, 11000])
+    def test_upscale_validates_width_range(self, client, bmp_upload, target_width):
         """Test that width is validated."""
-        img_bytes = self.create_test_image()
-
-        # Test width too small
-        response = client.post(
-            "/upscale",
-            files={"image": ("test.jpg", img_bytes, "image/jpeg")},
-            data={"target_width": 0, "target_height": 400},
-        )
-        assert response.status_code == 400
-
-        # Test width too large
-        img_bytes = self.create_test_image()
         response = client.post(
-            "/upscale",
-            files={"image": ("test.jpg", img_bytes, "image/jpeg")},
-            data={"target_width": 11000, "target_height": 400},
+            "/upscale", **bmp_upload(target_width=target_width, target_height=400)
         )
-        assert response.status_code == 400
+        assert response.status_code == 422
 
-    def test_upscale_validates_height_range(self):
+    @pytest.mark.parametrize("target_height", [0, 11000])
+    def test_upscale_validates_height_range(self, client, bmp_upload, target_height):
         """Test that height is validated."""
-        img_bytes = self.create_test_image()
-
-        # Test height too small
         response = client.post(
-            "/upscale",
-            files={"image": ("test.jpg", img_bytes, "image/jpeg")},
-            data={"target_width": 400, "target_height": 0},
+            "/upscale", **bmp_upload(target_width=400, target_height=target_height)
         )
-        assert response.status_code == 400
+        assert response.status_code == 422
 
-        # Test height too large
-        img_bytes = self.create_test_image()
-        response = client.post(
-            "/upscale",
-            files={"image": ("test.jpg", img_bytes, "image/jpeg")},
-            data={"target_width": 400, "target_height": 11000},
-        )
-        assert response.status_code == 400
-
-    def test_upscale_rejects_non_image(self):
+    def test_upscale_rejects_non_image(self, client):
         """Test that non-image files are rejected."""
         # Create a text file
         text_file = io.BytesIO(b"This is not an image")
@@ -118,8 +108,31 @@ class TestUpscaleEndpoint:
         )
         assert response.status_code == 400
 
+    def test_upscale_rejects_non_image_with_image_content_type(self, client):
+        """Test that uploads are rejected by their content, not just the declared type."""
+        with patch("upscaler.app.Image.open") as image_open:
+            response = client.post(
+                "/upscale",
+                files={"image": ("test.jpg", b"This is not an image", "image/jpeg")},
+                data={"target_width": 400, "target_height": 400},
+            )
+
+        assert response.status_code == 400
+        image_open.assert_not_called()
+
+    def test_upscale_rejects_large_upload(self, client, bmp_upload):
+        """Test that uploads above the size limit are rejected before decoding."""
+        with (
+            patch("upscaler.app.MAX_UPLOAD_BYTES", 1024),
+            patch("upscaler.app.Image.open") as image_open,
+        ):
+            response = client.post("/upscale", **bmp_upload(target_width=400, target_height=400))
+
+        assert response.status_code == 413
+        image_open.assert_not_called()
+
     @pytest.mark.slow
-    def test_upscale_success(self, panda_test_image):
+    def test_upscale_success(self, client, panda_test_image):
         """Test successful image upscaling with real panda image (slow test, requires model)."""
         # Load the real test image
         img_bytes = panda_test_image
@@ -133,106 +146,45 @@ class TestUpscaleEndpoint:
         # This test requires the Real-ESRGAN model to be initialized
         assert response.status_code == 200, f"Expected 200, got {response.status_code}"
 
-        assert response.headers["content-type"] == "image/png"
+        assert response.headers["content-type"] == "image/webp"
         # Verify we got an image back
         output_img = Image.open(io.BytesIO(response.content))
+        assert output_img.format == "WEBP"
         assert output_img.size[0] <= 512
         assert output_img.size[1] <= 512
         # Verify it's actually upscaled (should be larger than original low-res image)
         assert output_img.size[0] > 100  # Should be significantly larger than tiny dimensions
 
-    def test_upscale_with_cm_dpi_requires_all_params(self):
+    def test_upscale_with_cm_dpi_requires_all_params(self, client, bmp_upload):
         """Test that cm/dpi mode requires all three parameters."""
-        img_bytes = self.create_test_image()
-
         # Missing dpi
-        response = client.post(
-            "/upscale",
-            files={"image": ("test.jpg", img_bytes, "image/jpeg")},
-            data={"width_cm": 10, "height_cm": 10},
-        )
-        assert response.status_code == 400
+        response = client.post("/upscale", **bmp_upload(width_cm=10, height_cm=10))
+        assert response.status_code == 422
 
         # Missing height_cm
-        img_bytes = self.create_test_image()
-        response = client.post(
-            "/upscale",
-            files={"image": ("test.jpg", img_bytes, "image/jpeg")},
-            data={"width_cm": 10, "dpi": 300},
-        )
-        assert response.status_code == 400
+        response = client.post("/upscale", **bmp_upload(width_cm=10, dpi=300))
+        assert response.status_code == 422
 
         # Missing width_cm
-        img_bytes = self.create_test_image()
-        response = client.post(
-            "/upscale",
-            files={"image": ("test.jpg", img_bytes, "image/jpeg")},
-            data={"height_cm": 10, "dpi": 300},
-        )
-        assert response.status_code == 400
+        response = client.post("/upscale", **bmp_upload(height_cm=10, dpi=300))
+        assert response.status_code == 422
 
-    def test_upscale_validates_cm_range(self):
+    @pytest.mark.parametrize("width_cm, height_cm", [(0.05, 10), (500, 10), (10, 0.05), (10, 500)])
+    def test_upscale_validates_cm_range(self, client, bmp_upload, width_cm, height_cm):
         """Test that cm dimensions are validated."""
-        img_bytes = self.create_test_image()
-
-        # Width too small
-        response = client.post(
-            "/upscale",
-            files={"image": ("test.jpg", img_bytes, "image/jpeg")},
-            data={"width_cm": 0.05, "height_cm": 10, "dpi": 300},
-        )
-        assert response.status_code == 400
-
-        # Width too large
-        img_bytes = self.create_test_image()
-        response = client.post(
-            "/upscale",
-            files={"image": ("test.jpg", img_bytes, "image/jpeg")},
-            data={"width_cm": 500, "height_cm": 10, "dpi": 300},
-        )
-        assert response.status_code == 400
-
-        # Height too small
-        img_bytes = self.create_test_image()
-        response = client.post(
-            "/upscale",
-            files={"image": ("test.jpg", img_bytes, "image/jpeg")},
-            data={"width_cm": 10, "height_cm": 0.05, "dpi": 300},
-        )
-        assert response.status_code == 400
-
-        # Height too large
-        img_bytes = self.create_test_image()
         response = client.post(
-            "/upscale",
-            files={"image": ("test.jpg", img_bytes, "image/jpeg")},
-            data={"width_cm": 10, "height_cm": 500, "dpi": 300},
+            "/upscale", **bmp_upload(width_cm=width_cm, height_cm=height_cm, dpi=300)
         )
-        assert response.status_code == 400
+        assert response.status_code == 422
 
-    def test_upscale_validates_dpi_range(self):
+    @pytest.mark.parametrize("dpi", [5, 1500])
+    def test_upscale_validates_dpi_range(self, client, bmp_upload, dpi):
         """Test that DPI is validated."""
-        img_bytes = self.create_test_image()
-
-        # DPI too small
-        response = client.post(
-            "/upscale",
-            files={"image": ("test.jpg", img_bytes, "image/jpeg")},
-            data={"width_cm": 10, "height_cm": 10, "dpi": 5},
-        )
-        assert response.status_code == 400
-
-        # DPI too large
-        img_bytes = self.create_test_image()
-        response = client.post(
-            "/upscale",
-            files={"image": ("test.jpg", img_bytes, "image/jpeg")},
-            data={"width_cm": 10, "height_cm": 10, "dpi": 1500},
-        )
-        assert response.status_code == 400
+        response = client.post("/upscale", **bmp_upload(width_cm=10, height_cm=10, dpi=dpi))
+        assert response.status_code == 422
 
     @pytest.mark.slow
-    def test_upscale_success_with_cm_dpi(self, panda_test_image):
+    def test_upscale_success_with_cm_dpi(self, client, panda_test_image):
         """Test successful image upscaling using cm/dpi with real panda image (slow test, requires model)."""
         # Load the real test image
         img_bytes = panda_test_image
@@ -240,6 +192,7 @@ class TestUpscaleEndpoint:
         # 10cm x 10cm at 150 DPI = approximately 591x591 pixels
         response = client.post(
             "/upscale",
+            params={"format": "png"},
             files={"image": ("panda-low.jpeg", img_bytes, "image/jpeg")},
             data={"width_cm": 10, "height_cm": 10, "dpi": 150},
         )
@@ -256,14 +209,141 @@ class TestUpscaleEndpoint:
         assert output_img.size[1] <= 591
         assert output_img.size[0] > 100  # Should be upscaled
 
-    def test_upscale_requires_either_pixels_or_cm_dpi(self):
-        """Test that endpoint requires either pixel or cm/dpi parameters."""
-        img_bytes = self.create_test_image()
+    def test_upscale_rejects_unknown_format(self, client, bmp_upload):
+        """Test that only supported output formats are accepted."""
+        response = client.post(
+            "/upscale", params={"format": "gif"}, **bmp_upload(target_width=400, target_height=400)
+        )
+        assert response.status_code == 422
+
+    def test_upscale_returns_requested_format(self, client):
+        """Test that downscaling requests skip the model and honor the output format."""
+        img_bytes = self.create_test_image(width=800, height=800)
 
-        # No dimension parameters at all
         response = client.post(
             "/upscale",
+            params={"format": "png"},
             files={"image": ("test.jpg", img_bytes, "image/jpeg")},
-            data={},
+            data={"target_width": 400, "target_height": 400},
         )
-        assert response.status_code == 400
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "image/png"
+        assert "upscaled_test.png" in response.headers["content-disposition"]
+        output_img = Image.open(io.BytesIO(response.content))
+        assert output_img.format == "PNG"
+        assert output_img.size == (400, 400)
+
+    def test_upscale_caches_identical_requests(self, client):
+        """Test that an identical upload is answered from the result cache."""
+        payload = self.create_test_image(width=600, height=600, color="blue")
+
+        with patch("upscaler.app.resize_image", wraps=resize_image) as resize:
+            responses = [
+                client.post(
+                    "/upscale",
+                    files={"image": ("test.jpg", payload, "image/jpeg")},
+                    data={"target_width": 300, "target_height": 300},
+                )
+                for _ in range(2)
+            ]
+
+        assert [r.status_code for r in responses] == [200, 200]
+        assert responses[0].content == responses[1].content
+        assert resize.call_count == 1
+
+    def test_result_cache_stays_within_byte_budget(self):
+        """Test that the result cache evicts by total size and skips oversized results."""
+        with (
+            patch.dict("upscaler.app._result_cache", clear=True),
+            patch("upscaler.app.RESULT_CACHE_BYTES", 10),
+        ):
+            app_module._cache_result("a", b"1234")
+            app_module._cache_result("b", b"1234")
+            app_module._cache_result("c", b"1234")
+            app_module._cache_result("huge", b"x" * 11)
+
+            assert list(app_module._result_cache) == ["b", "c"]
+
+    def test_upscale_requires_either_pixels_or_cm_dpi(self, client, bmp_upload):
+        """Test that endpoint requires either pixel or cm/dpi parameters."""
+        # No dimension parameters at all
+        response = client.post("/upscale", **bmp_upload())
+        assert response.status_code == 422
+
+
+class TestRequestBatching:
+    """Tests for the micro-batching of concurrent upscale requests."""
+
+    @staticmethod
+    def post_concurrently(count):
+        """Send count upscale requests at once to an app running its own lifespan."""
+        colors = ["red", "green", "blue", "white", "black", "yellow"][:count]
+        uploads = []
+        for color in colors:
+            img_bytes = io.BytesIO()
+            Image.new("RGB", (50, 50), color=color).save(img_bytes, format="JPEG")
+            uploads.append(img_bytes.getvalue())
+
+        async def run():
+            async with app_module.lifespan(app_module.app):
+                transport = httpx.ASGITransport(app=app_module.app)
+                async with httpx.AsyncClient(
+                    transport=transport, base_url="http://testserver"
+                ) as async_client:
+                    requests = [
+                        async_client.post(
+                            "/upscale",
+                            files={"image": ("test.jpg", upload, "image/jpeg")},
+                            data={"target_width": 200, "target_height": 200},
+                        )
+                        for upload in uploads
+                    ]
+                    return await asyncio.gather(*requests)
+
+        # Keep the batcher of the session client in place once this lifespan exits,
+        # and start from an empty result cache so every request reaches the model
+        with (
+            patch("upscaler.app._batch_queue", None),
+            patch.dict("upscaler.app._result_cache", clear=True),
+        ):
+            return asyncio.run(run())
+
+    def test_concurrent_requests_share_one_forward_pass(self):
+        """Test that same-shaped concurrent requests are grouped into one model call."""
+        batch_sizes = []
+
+        def fake_enhance_batch(images, sizes):
+            batch_sizes.append(len(images))
+            return [np.zeros((height, width, 3), dtype=np.uint8) for width, height in sizes]
+
+        with (
+            patch("upscaler.app.enhance_batch", side_effect=fake_enhance_batch),
+            patch("upscaler.app.BATCH_WINDOW", 1.0),
+            patch("upscaler.app.MAX_BATCH", 3),
+        ):
+            responses = self.post_concurrently(3)
+
+        assert [r.status_code for r in responses] == [200, 200, 200]
+        assert batch_sizes == [3]
+        assert Image.open(io.BytesIO(responses[0].content)).size == (200, 200)
+
+    def test_full_queue_makes_callers_wait(self):
+        """Test that requests beyond MAX_QUEUE wait for room instead of failing."""
+        queue_sizes = []
+
+        def slow_enhance_batch(images, sizes):
+            queue_sizes.append(app_module._batch_queue.qsize())
+            time.sleep(0.05)
+            return [np.zeros((height, width, 3), dtype=np.uint8) for width, height in sizes]
+
+        with (
+            patch("upscaler.app.enhance_batch", side_effect=slow_enhance_batch),
+            patch("upscaler.app.MAX_QUEUE", 1),
+            patch("upscaler.app.MAX_BATCH", 1),
+        ):
+            responses = self.post_concurrently(4)
+
+        assert [r.status_code for r in responses] == [200] * 4
+        assert len(queue_sizes) == 4
+        # The queue filled up while the model was busy, but never beyond its bound
+        assert max(queue_sizes) == 1
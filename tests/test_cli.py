@@ -2,156 +2,199 @@
 Tests for the CLI module.
 """
 
-import sys
+import io
+import logging
 from pathlib import Path
 from unittest.mock import patch
 
 import pytest
-
-# Add src to path for imports
-sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
-
 from PIL import Image
 
 from upscaler.cli import main, upscale_images_batch
+from upscaler.upscaler import cm_to_pixels
 
 
 class TestUpscaleImagesBatch:
     """Tests for the upscale_images_batch function."""
 
-    def test_no_matching_files(self, tmp_path, caplog):
+    def test_no_matching_files(self, tmp_path, monkeypatch):
         """Test that function returns error when no files match pattern."""
         # Change to temp directory
-        import os
+        monkeypatch.chdir(tmp_path)
 
-        original_dir = os.getcwd()
-        os.chdir(tmp_path)
+        result = upscale_images_batch("*.jpg", target_width=800, target_height=600)
+        assert result == 1
+
+    def test_invalid_image_file(self, tmp_path, monkeypatch, caplog):
+        """Test handling of invalid image files."""
+        monkeypatch.chdir(tmp_path)
 
-        try:
+        # Create a non-image file with image extension
+        invalid_file = tmp_path / "test.jpg"
+        invalid_file.write_text("not an image")
+
+        with caplog.at_level(logging.ERROR, logger="upscaler.cli"):
             result = upscale_images_batch("*.jpg", target_width=800, target_height=600)
-            assert result == 1
+        # Should return 1 as no images were successfully processed
+        assert result == 1
 
-            assert "No files found" in caplog.text
-        finally:
-            os.chdir(original_dir)
+        assert "Failed to process" in caplog.text
 
-    def test_invalid_image_file(self, tmp_path, caplog):
-        """Test handling of invalid image files."""
-        import os
+    def test_skips_matching_directories(self, tmp_path, monkeypatch):
+        """Test that directories matching the pattern are not treated as images."""
+        monkeypatch.chdir(tmp_path)
 
-        original_dir = os.getcwd()
-        os.chdir(tmp_path)
+        (tmp_path / "album.png").mkdir()
+        assert upscale_images_batch("*.png", target_width=800, target_height=600) == 1
 
-        try:
-            # Create a non-image file with image extension
-            invalid_file = tmp_path / "test.jpg"
-            invalid_file.write_text("not an image")
+        Image.new("RGB", (400, 400), color="red").save(tmp_path / "photo.png")
+        assert upscale_images_batch("*.png", target_width=200, target_height=200) == 0
+        assert not (tmp_path / "album_upscaled.png").exists()
 
-            result = upscale_images_batch("*.jpg", target_width=800, target_height=600)
-            # Should return 1 as no images were successfully processed
-            assert result == 1
+    def test_batch_failure_retries_files_individually(self, tmp_path, monkeypatch):
+        """Test that a failed batched model call only loses the files that fail alone."""
+        monkeypatch.chdir(tmp_path)
 
-            assert "Failed to process" in caplog.text
-        finally:
-            os.chdir(original_dir)
+        Image.new("RGB", (100, 100), color="red").save(tmp_path / "good.png")
+        Image.new("RGB", (100, 100), color="black").save(tmp_path / "bad.png")
 
-    def test_successful_single_image_processing(self, tmp_path):
-        """Test successful processing of a single image."""
-        import os
+        def upscale_alone(img, target_width, target_height):
+            if img.getpixel((0, 0)) == (0, 0, 0):
+                raise RuntimeError("CUDA out of memory")
+            return img
 
-        original_dir = os.getcwd()
-        os.chdir(tmp_path)
+        with (
+            patch("upscaler.cli.upscale_image_batch", side_effect=RuntimeError("batch failed")),
+            patch("upscaler.cli.upscale_image", side_effect=upscale_alone),
+        ):
+            result = upscale_images_batch("*.png", target_width=400, target_height=400)
 
-        try:
-            # Create a simple test image
-            img = Image.new("RGB", (100, 100), color="red")
-            test_file = tmp_path / "test.jpg"
-            img.save(test_file)
+        assert result == 0
+        assert (tmp_path / "good_upscaled.png").exists()
+        assert not (tmp_path / "bad_upscaled.png").exists()
 
-            result = upscale_images_batch("test.jpg", target_width=400, target_height=400)
-            assert result == 0
+    def test_decompression_bomb_is_skipped(self, tmp_path, monkeypatch):
+        """Test that an image over Pillow's pixel limit fails alone instead of aborting the run."""
+        monkeypatch.chdir(tmp_path)
 
-            # Check output file exists
-            output_file = tmp_path / "test_upscaled.jpg"
-            assert output_file.exists()
+        Image.new("RGB", (400, 400), color="red").save(tmp_path / "bomb.png")
+        Image.new("RGB", (100, 100), color="red").save(tmp_path / "small.png")
+        # Twice the limit is an error rather than a warning
+        monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 100 * 100)
 
-            # Verify output image
-            output_img = Image.open(output_file)
-            assert output_img.size == (400, 400)
-        finally:
-            os.chdir(original_dir)
+        result = upscale_images_batch("*.png", target_width=50, target_height=50)
 
-    def test_glob_pattern_multiple_files(self, tmp_path):
-        """Test processing multiple files with glob pattern."""
-        import os
+        assert result == 0
+        assert (tmp_path / "small_upscaled.png").exists()
+        assert not (tmp_path / "bomb_upscaled.png").exists()
 
-        original_dir = os.getcwd()
-        os.chdir(tmp_path)
+    def test_files_are_processed_in_sorted_order(self, tmp_path, monkeypatch):
+        """Test that matches are processed in name order, independent of the filesystem."""
+        monkeypatch.chdir(tmp_path)
 
-        try:
-            # Create multiple test images
-            for i in range(3):
-                img = Image.new("RGB", (50, 50), color="blue")
-                img.save(tmp_path / f"test{i}.png")
+        for name in ["c.png", "a.png", "b.png"]:
+            Image.new("RGB", (100, 100), color="red").save(tmp_path / name)
 
-            result = upscale_images_batch("*.png", target_width=200, target_height=200)
-            assert result == 0
+        processed = []
 
-            # Check all output files exist
-            for i in range(3):
-                output_file = tmp_path / f"test{i}_upscaled.png"
-                assert output_file.exists()
-        finally:
-            os.chdir(original_dir)
+        def record(imgs, target_width, target_height):
+            processed.extend(Path(img.filename).name for img in imgs)
+            return imgs
 
-    def test_subdirectory_glob_pattern(self, tmp_path):
-        """Test glob pattern with subdirectory."""
-        import os
+        with patch("upscaler.cli.upscale_image_batch", side_effect=record):
+            assert upscale_images_batch("*.png", target_width=400, target_height=400) == 0
 
-        original_dir = os.getcwd()
-        os.chdir(tmp_path)
+        assert processed == ["a.png", "b.png", "c.png"]
 
-        try:
-            # Create subdirectory with images
-            subdir = tmp_path / "images"
-            subdir.mkdir()
+    def test_successful_single_image_processing(self, tmp_path, monkeypatch):
+        """Test successful processing of a single image."""
+        monkeypatch.chdir(tmp_path)
 
-            img = Image.new("RGB", (100, 100), color="green")
-            img.save(subdir / "test.jpg")
+        # Create a simple test image
+        img = Image.new("RGB", (100, 100), color="red")
+        test_file = tmp_path / "test.jpg"
+        img.save(test_file)
 
-            result = upscale_images_batch("images/*.jpg", target_width=400, target_height=400)
-            assert result == 0
+        result = upscale_images_batch("test.jpg", target_width=400, target_height=400)
+        assert result == 0
 
-            # Check output file exists in subdirectory
-            output_file = subdir / "test_upscaled.jpg"
+        # Check output file exists
+        output_file = tmp_path / "test_upscaled.jpg"
+        assert output_file.exists()
+
+        # Verify output image
+        output_img = Image.open(output_file)
+        assert output_img.size == (400, 400)
+
+    def test_glob_pattern_multiple_files(self, tmp_path, monkeypatch):
+        """Test processing multiple files with glob pattern."""
+        monkeypatch.chdir(tmp_path)
+
+        # Create multiple test images
+        for i in range(3):
+            img = Image.new("RGB", (50, 50), color="blue")
+            img.save(tmp_path / f"test{i}.png")
+
+        result = upscale_images_batch("*.png", target_width=200, target_height=200)
+        assert result == 0
+
+        # Check all output files exist
+        for i in range(3):
+            output_file = tmp_path / f"test{i}_upscaled.png"
             assert output_file.exists()
-        finally:
-            os.chdir(original_dir)
 
-    def test_preserves_aspect_ratio(self, tmp_path):
+    def test_subdirectory_glob_pattern(self, tmp_path, monkeypatch):
+        """Test glob pattern with subdirectory."""
+        monkeypatch.chdir(tmp_path)
+
+        # Create subdirectory with images
+        subdir = tmp_path / "images"
+        subdir.mkdir()
+
+        img = Image.new("RGB", (100, 100), color="green")
+        img.save(subdir / "test.jpg")
+
+        result = upscale_images_batch("images/*.jpg", target_width=400, target_height=400)
+        assert result == 0
+
+        # Check output file exists in subdirectory
+        output_file = subdir / "test_upscaled.jpg"
+        assert output_file.exists()
+
+    def test_preserves_aspect_ratio(self, tmp_path, monkeypatch):
         """Test that aspect ratio is preserved during upscaling."""
-        import os
+        monkeypatch.chdir(tmp_path)
 
-        original_dir = os.getcwd()
-        os.chdir(tmp_path)
+        # Create a wide image (2:1 aspect ratio)
+        img = Image.new("RGB", (200, 100), color="purple")
+        test_file = tmp_path / "wide.jpg"
+        img.save(test_file)
 
-        try:
-            # Create a wide image (2:1 aspect ratio)
-            img = Image.new("RGB", (200, 100), color="purple")
-            test_file = tmp_path / "wide.jpg"
-            img.save(test_file)
+        result = upscale_images_batch("wide.jpg", target_width=800, target_height=600)
+        assert result == 0
 
-            result = upscale_images_batch("wide.jpg", target_width=800, target_height=600)
-            assert result == 0
+        # Check output preserves aspect ratio
+        output_file = tmp_path / "wide_upscaled.jpg"
+        output_img = Image.open(output_file)
+
+        # Should be limited by width: 800x400
+        assert output_img.size == (800, 400)
+
+    def test_multiple_worker_processes(self, tmp_path, monkeypatch):
+        """Test that files are fanned out to worker processes."""
+        monkeypatch.chdir(tmp_path)
+
+        for i in range(3):
+            Image.new("RGB", (400, 400), color="blue").save(tmp_path / f"test{i}.png")
+        (tmp_path / "broken.png").write_text("not an image")
 
-            # Check output preserves aspect ratio
-            output_file = tmp_path / "wide_upscaled.jpg"
-            output_img = Image.open(output_file)
+        # Downscale targets skip the model, so the workers never load it
+        result = upscale_images_batch("*.png", target_width=200, target_height=200, workers=2)
+        assert result == 0
 
-            # Should be limited by width: 800x400
-            assert output_img.size == (800, 400)
-        finally:
-            os.chdir(original_dir)
+        for i in range(3):
+            assert Image.open(tmp_path / f"test{i}_upscaled.png").size == (200, 200)
+        assert not (tmp_path / "broken_upscaled.png").exists()
 
 
 class TestMainCLI:
@@ -167,7 +210,8 @@ class TestMainCLI:
     def test_invalid_width(self, caplog):
         """Test validation of width parameter."""
         with patch("sys.argv", ["upscaler-cli", "*.jpg", "-w", "20000", "--height", "600"]):
-            result = main()
+            with caplog.at_level(logging.ERROR, logger="upscaler.cli"):
+                result = main()
             assert result == 1
 
             assert "Width must be between" in caplog.text
@@ -175,7 +219,8 @@ class TestMainCLI:
     def test_invalid_height(self, caplog):
         """Test validation of height parameter."""
         with patch("sys.argv", ["upscaler-cli", "*.jpg", "-w", "800", "--height", "0"]):
-            result = main()
+            with caplog.at_level(logging.ERROR, logger="upscaler.cli"):
+                result = main()
             assert result == 1
 
             assert "Height must be between" in caplog.text
@@ -186,83 +231,64 @@ class TestMainCLI:
             result = main()
             assert result == 1
 
-    def test_verbose_flag(self, tmp_path):
+    def test_verbose_flag(self, tmp_path, monkeypatch):
         """Test that verbose flag enables debug logging."""
-        import os
+        monkeypatch.chdir(tmp_path)
 
-        original_dir = os.getcwd()
-        os.chdir(tmp_path)
+        # Create a test image
+        img = Image.new("RGB", (100, 100), color="red")
+        test_file = tmp_path / "test.jpg"
+        img.save(test_file)
 
-        try:
-            # Create a test image
-            img = Image.new("RGB", (100, 100), color="red")
-            test_file = tmp_path / "test.jpg"
-            img.save(test_file)
-
-            with patch(
-                "sys.argv", ["upscaler-cli", "-v", "test.jpg", "-w", "400", "--height", "400"]
-            ):
-                result = main()
-                assert result == 0
-        finally:
-            os.chdir(original_dir)
+        with patch("sys.argv", ["upscaler-cli", "-v", "test.jpg", "-w", "400", "--height", "400"]):
+            result = main()
+            assert result == 0
 
-    def test_cm_dpi_mode(self, tmp_path):
+    def test_cm_dpi_mode(self, tmp_path, monkeypatch):
         """Test processing with cm and DPI mode."""
-        import os
+        monkeypatch.chdir(tmp_path)
 
-        original_dir = os.getcwd()
-        os.chdir(tmp_path)
+        # Create a test image
+        img = Image.new("RGB", (100, 100), color="blue")
+        test_file = tmp_path / "test.jpg"
+        img.save(test_file)
 
-        try:
-            # Create a test image
-            img = Image.new("RGB", (100, 100), color="blue")
-            test_file = tmp_path / "test.jpg"
-            img.save(test_file)
+        target_width, target_height = cm_to_pixels(10.0, 10.0, 100)
+        result = upscale_images_batch("test.jpg", target_width, target_height)
+        assert result == 0
 
-            result = upscale_images_batch("test.jpg", width_cm=10.0, height_cm=10.0, dpi=100)
-            assert result == 0
+        # Check output file exists
+        output_file = tmp_path / "test_upscaled.jpg"
+        assert output_file.exists()
 
-            # Check output file exists
-            output_file = tmp_path / "test_upscaled.jpg"
-            assert output_file.exists()
-        finally:
-            os.chdir(original_dir)
-
-    def test_cm_dpi_mode_cli(self, tmp_path):
+    def test_cm_dpi_mode_cli(self, tmp_path, monkeypatch):
         """Test CLI with cm and DPI arguments."""
-        import os
-
-        original_dir = os.getcwd()
-        os.chdir(tmp_path)
-
-        try:
-            # Create a test image
-            img = Image.new("RGB", (100, 100), color="green")
-            test_file = tmp_path / "test.jpg"
-            img.save(test_file)
-
-            with patch(
-                "sys.argv",
-                [
-                    "upscaler-cli",
-                    "test.jpg",
-                    "--width-cm",
-                    "10",
-                    "--height-cm",
-                    "10",
-                    "--dpi",
-                    "100",
-                ],
-            ):
-                result = main()
-                assert result == 0
+        monkeypatch.chdir(tmp_path)
 
-            # Check output file exists
-            output_file = tmp_path / "test_upscaled.jpg"
-            assert output_file.exists()
-        finally:
-            os.chdir(original_dir)
+        # Create a test image
+        img = Image.new("RGB", (100, 100), color="green")
+        test_file = tmp_path / "test.jpg"
+        img.save(test_file)
+
+        with patch(
+            "sys.argv",
+            [
+                "upscaler-cli",
+                "test.jpg",
+                "--width-cm",
+                "10",
+                "--height-cm",
+                "10",
+                "--dpi",
+                "100",
+            ],
+        ):
+            result = main()
+            assert result == 0
+
+        # Check output file exists
+        output_file = tmp_path / "test_upscaled.jpg"
+        assert output_file.exists()
 
     def test_mixed_mode_error(self, caplog):
         """Test that mixing pixel and cm modes produces error."""
@@ -279,6 +305,120 @@ class TestMainCLI:
                 "10",
             ],
         ):
-            result = main()
+            with caplog.at_level(logging.ERROR, logger="upscaler.cli"):
+                result = main()
             assert result == 1
             assert "Cannot mix" in caplog.text
+
+    def test_invalid_png_compress_level(self, caplog):
+        """Test validation of the PNG compression level."""
+        with patch(
+            "sys.argv",
+            ["upscaler-cli", "*.jpg", "-w", "800", "--height", "600", "--png-compress", "10"],
+        ):
+            with caplog.at_level(logging.ERROR, logger="upscaler.cli"):
+                result = main()
+            assert result == 1
+            assert "PNG compression level must be between" in caplog.text
+
+    def test_output_format_follows_suffix(self, tmp_path, monkeypatch):
+        """Test that .jpg outputs are written as JPEG and other outputs as PNG."""
+        monkeypatch.chdir(tmp_path)
+
+        Image.new("RGB", (400, 400), color="red").save(tmp_path / "photo.jpg")
+        Image.new("RGB", (400, 400), color="red").save(tmp_path / "scan.bmp")
+
+        # Downscale targets skip the model
+        assert upscale_images_batch("photo.jpg", target_width=200, target_height=200) == 0
+        assert upscale_images_batch("scan.bmp", target_width=200, target_height=200) == 0
+
+        assert Image.open(tmp_path / "photo_upscaled.jpg").format == "JPEG"
+        assert Image.open(tmp_path / "scan_upscaled.png").format == "PNG"
+
+    def test_serve_reads_patterns_from_stdin(self, tmp_path, monkeypatch):
+        """Test that --serve loads the model once and processes each stdin pattern."""
+        monkeypatch.chdir(tmp_path)
+
+        for name in ["a.png", "b.png"]:
+            Image.new("RGB", (400, 400), color="red").save(tmp_path / name)
+
+        with (
+            patch("sys.argv", ["upscaler-cli", "--serve", "-w", "200", "--height", "200"]),
+            patch("sys.stdin", io.StringIO("a.png\n\nb.png\n")),
+            patch("upscaler.cli.get_upsampler") as get_upsampler,
+        ):
+            result = main()
+
+        assert result == 0
+        get_upsampler.assert_called_once()
+        assert (tmp_path / "a_upscaled.png").exists()
+        assert (tmp_path / "b_upscaled.png").exists()
+
+    def test_serve_survives_invalid_patterns(self, tmp_path, monkeypatch):
+        """Test that --serve logs bad stdin patterns and keeps processing later lines."""
+        monkeypatch.chdir(tmp_path)
+
+        Image.new("RGB", (400, 400), color="red").save(tmp_path / "a.png")
+        stdin = f"{tmp_path}/*.png\n**x/*.png\na.png\n"
+
+        with (
+            patch("sys.argv", ["upscaler-cli", "--serve", "-w", "200", "--height", "200"]),
+            patch("sys.stdin", io.StringIO(stdin)),
+            patch("upscaler.cli.get_upsampler"),
+        ):
+            result = main()
+
+        assert result == 1
+        assert (tmp_path / "a_upscaled.png").exists()
+
+    def test_missing_glob_pattern(self, caplog):
+        """Test that a glob pattern is required outside --serve mode."""
+        with patch("sys.argv", ["upscaler-cli", "-w", "800", "--height", "600"]):
+            with caplog.at_level(logging.ERROR, logger="upscaler.cli"):
+                result = main()
+            assert result == 1
+            assert "A glob pattern is required" in caplog.text
+
+    def test_format_flag_overrides_input_format(self, tmp_path, monkeypatch):
+        """Test that --format writes every output in the requested format."""
+        monkeypatch.chdir(tmp_path)
+
+        Image.new("RGB", (400, 400), color="red").save(tmp_path / "photo.png")
+
+        with patch(
+            "sys.argv",
+            ["upscaler-cli", "photo.png", "-w", "200", "--height", "200", "--format", "jpeg"],
+        ):
+            result = main()
+
+        assert result == 0
+        assert Image.open(tmp_path / "photo_upscaled.jpg").format == "JPEG"
+
+    def test_fast_draft_flag_decodes_reduced_scale(self, tmp_path, monkeypatch):
+        """Test that JPEGs are decoded at full resolution unless --fast-draft is given."""
+        monkeypatch.chdir(tmp_path)
+
+        Image.new("RGB", (1600, 1600), color="red").save(tmp_path / "photo.jpg")
+
+        for flags, expected_size in [([], (1600, 1600)), (["--fast-draft"], (400, 400))]:
+            with (
+                patch(
+                    "sys.argv",
+                    ["upscaler-cli", "photo.jpg", "-w", "400", "--height", "400", *flags],
+                ),
+                patch("upscaler.cli.upscale_image_batch", side_effect=lambda imgs, w, h: imgs),
+            ):
+                assert main() == 0
+
+            assert Image.open(tmp_path / "photo_upscaled.jpg").size == expected_size
+
+    def test_workers_cannot_combine_with_serve(self, caplog):
+        """Test that --workers is rejected in --serve mode."""
+        with patch(
+            "sys.argv",
+            ["upscaler-cli", "--serve", "-w", "800", "--height", "600", "--workers", "2"],
+        ):
+            with caplog.at_level(logging.ERROR, logger="upscaler.cli"):
+                result = main()
+            assert result == 1
+            assert "--workers cannot be combined with --serve" in caplog.text
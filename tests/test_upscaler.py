@@ -3,14 +3,19 @@ Unit tests for the upscaler module.
 """
 
 import sys
-from pathlib import Path
-
-# Add src to path for imports
-sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+from unittest.mock import MagicMock
 
+import numpy as np
+import pytest
 from PIL import Image
 
-from upscaler.upscaler import cm_to_pixels, resize_to_target
+from upscaler.upscaler import (
+    _configure_cpu_threads,
+    _select_tile_size,
+    cm_to_pixels,
+    cm_to_pixels_batch,
+    resize_to_target,
+)
 
 
 class TestCmToPixels:
@@ -64,39 +69,45 @@ class TestCmToPixels:
         assert isinstance(width_px, int)
         assert isinstance(height_px, int)
 
+    @pytest.mark.parametrize(
+        "width_cm, height_cm, dpi",
+        [(10, 10, 300), (21, 29.7, 300), (1, 1, 72), (5, 5, 600), (15, 10, 150), (7.5, 12.3, 200)],
+    )
+    def test_batch_matches_scalar(self, width_cm, height_cm, dpi):
+        """Test that the vectorized conversion agrees with the scalar one."""
+        result = cm_to_pixels_batch(np.array([[width_cm, height_cm]]), dpi)
+
+        assert result.dtype == np.int64
+        assert tuple(result[0]) == cm_to_pixels(width_cm, height_cm, dpi)
+
+
+# Solid-color inputs resize identically with any filter, so size-only tests use a cheap one
+BILINEAR = Image.Resampling.BILINEAR
+
 
 class TestResizeToTarget:
     """Tests for the resize_to_target function."""
 
-    def test_resize_wider_image(self):
+    def test_resize_wider_image(self, img_200x100_red):
         """Test resizing a wider image maintains aspect ratio."""
-        # Create a 200x100 image (2:1 aspect ratio)
-        img = Image.new("RGB", (200, 100), color="red")
-
-        # Resize to fit in 400x400
-        result = resize_to_target(img, 400, 400)
+        # Resize a 200x100 image (2:1 aspect ratio) to fit in 400x400
+        result = resize_to_target(img_200x100_red, 400, 400, resample=BILINEAR)
 
         # Should be 400x200 to maintain aspect ratio
         assert result.size == (400, 200)
 
-    def test_resize_taller_image(self):
+    def test_resize_taller_image(self, img_100x200_blue):
         """Test resizing a taller image maintains aspect ratio."""
-        # Create a 100x200 image (1:2 aspect ratio)
-        img = Image.new("RGB", (100, 200), color="blue")
-
-        # Resize to fit in 400x400
-        result = resize_to_target(img, 400, 400)
+        # Resize a 100x200 image (1:2 aspect ratio) to fit in 400x400
+        result = resize_to_target(img_100x200_blue, 400, 400, resample=BILINEAR)
 
         # Should be 200x400 to maintain aspect ratio
         assert result.size == (200, 400)
 
-    def test_resize_square_image(self):
+    def test_resize_square_image(self, img_100x100_green):
         """Test resizing a square image."""
-        # Create a 100x100 image
-        img = Image.new("RGB", (100, 100), color="green")
-
-        # Resize to fit in 500x500
-        result = resize_to_target(img, 500, 500)
+        # Resize a 100x100 image to fit in 500x500
+        result = resize_to_target(img_100x100_green, 500, 500, resample=BILINEAR)
 
         # Should be 500x500
         assert result.size == (500, 500)
@@ -105,10 +116,7 @@ class TestResizeToTarget:
         """Test that resizing maintains image content."""
         # Create a simple test pattern
         img = Image.new("RGB", (100, 100), color="white")
-        pixels = img.load()
-        for i in range(50):
-            for j in range(50):
-                pixels[i, j] = (255, 0, 0)  # Red square in top-left
+        img.paste((255, 0, 0), (0, 0, 50, 50))  # Red square in top-left
 
         # Resize
         result = resize_to_target(img, 200, 200)
@@ -120,13 +128,34 @@ class TestResizeToTarget:
         assert result_pixels[10, 10][1] < 50  # Low green
         assert result_pixels[10, 10][2] < 50  # Low blue
 
-    def test_resize_to_non_square_target(self):
-        """Test resizing to non-square target dimensions."""
-        # Create a square 100x100 image
-        img = Image.new("RGB", (100, 100), color="yellow")
+    def test_downscale_maintains_content(self):
+        """Test that downscaling maintains image content."""
+        # Red left half, blue right half
+        img = Image.new("RGB", (400, 200), color="blue")
+        img.paste((255, 0, 0), (0, 0, 200, 200))
 
-        # Resize to fit in 800x400 (2:1 target)
-        result = resize_to_target(img, 800, 400)
+        result = resize_to_target(img, 100, 100)
+
+        assert result.size == (100, 50)
+        assert result.mode == "RGB"
+        assert result.getpixel((10, 25)) == (255, 0, 0)
+        assert result.getpixel((90, 25)) == (0, 0, 255)
+
+    def test_resize_uses_requested_filter(self):
+        """Test that a non-default filter is used for both upscales and downscales."""
+        img = Image.new("RGB", (4, 4), color="white")
+        img.paste((0, 0, 0), (0, 0, 2, 4))  # Black left half
+
+        upscaled = resize_to_target(img, 8, 8, resample=Image.Resampling.NEAREST)
+        downscaled = resize_to_target(img, 2, 2, resample=Image.Resampling.NEAREST)
+
+        assert upscaled.tobytes() == img.resize((8, 8), Image.Resampling.NEAREST).tobytes()
+        assert downscaled.tobytes() == img.resize((2, 2), Image.Resampling.NEAREST).tobytes()
+
+    def test_resize_to_non_square_target(self, img_100x100_green):
+        """Test resizing to non-square target dimensions."""
+        # Resize a square 100x100 image to fit in 800x400 (2:1 target)
+        result = resize_to_target(img_100x100_green, 800, 400, resample=BILINEAR)
 
         # Should be 400x400 (limited by height)
         assert result.size == (400, 400)
@@ -135,14 +164,14 @@ class TestResizeToTarget:
         """Test various aspect ratio combinations."""
         # 16:9 image into 4:3 target
         img = Image.new("RGB", (1600, 900), color="purple")
-        result = resize_to_target(img, 800, 600)
+        result = resize_to_target(img, 800, 600, resample=BILINEAR)
 
         # Should be 800x450 (limited by width)
         assert result.size == (800, 450)
 
         # 4:3 image into 16:9 target
         img2 = Image.new("RGB", (400, 300), color="orange")
-        result2 = resize_to_target(img2, 1920, 1080)
+        result2 = resize_to_target(img2, 1920, 1080, resample=BILINEAR)
 
         # Should be 1440x1080 (limited by height)
         assert result2.size == (1440, 1080)
@@ -167,3 +196,67 @@ class TestResizeToTarget:
 
         # Verify it's still an RGB image
         assert result.mode == "RGB"
+
+
+class TestSelectTileSize:
+    """Tests for the _select_tile_size function."""
+
+    @pytest.fixture(autouse=True)
+    def no_override(self, monkeypatch):
+        """Run every test without a UPSCALER_TILE override from the environment."""
+        monkeypatch.delenv("UPSCALER_TILE", raising=False)
+
+    def with_vram(self, monkeypatch, gib):
+        """Make torch report a CUDA device with the given amount of memory."""
+        torch = MagicMock()
+        torch.cuda.get_device_properties.return_value.total_memory = gib * 1024**3
+        monkeypatch.setitem(sys.modules, "torch", torch)
+
+    def test_cpu_does_not_tile(self):
+        """Test that CPU inference processes the whole image in one pass."""
+        assert _select_tile_size(use_cuda=False) == 0
+
+    @pytest.mark.parametrize("gib, tile", [(24, 0), (12, 512), (8, 256), (6, 256), (2, 128)])
+    def test_tile_follows_vram(self, monkeypatch, gib, tile):
+        """Test that the tile size shrinks with the available VRAM."""
+        self.with_vram(monkeypatch, gib)
+        assert _select_tile_size(use_cuda=True) == tile
+
+    @pytest.mark.parametrize("use_cuda", [False, True])
+    def test_env_override(self, monkeypatch, use_cuda):
+        """Test that UPSCALER_TILE takes precedence over the automatic choice."""
+        self.with_vram(monkeypatch, 24)
+        monkeypatch.setenv("UPSCALER_TILE", "384")
+        assert _select_tile_size(use_cuda=use_cuda) == 384
+
+    @pytest.mark.parametrize("value", ["-1", "big", "256.5", ""])
+    def test_invalid_env_override(self, monkeypatch, value):
+        """Test that an invalid UPSCALER_TILE fails with a clear message."""
+        monkeypatch.setenv("UPSCALER_TILE", value)
+        with pytest.raises(RuntimeError, match="UPSCALER_TILE must be a non-negative integer"):
+            _select_tile_size(use_cuda=False)
+
+
+class TestConfigureCpuThreads:
+    """Tests for the _configure_cpu_threads function."""
+
+    @pytest.fixture
+    def torch(self, monkeypatch):
+        """Replace torch with a mock that records the thread settings."""
+        torch = MagicMock()
+        monkeypatch.setitem(sys.modules, "torch", torch)
+        return torch
+
+    def test_env_override(self, monkeypatch, torch):
+        """Test that UPSCALER_THREADS sets the number of intra-op threads."""
+        monkeypatch.setenv("UPSCALER_THREADS", "3")
+        _configure_cpu_threads()
+        torch.set_num_threads.assert_called_once_with(3)
+
+    @pytest.mark.parametrize("value", ["0", "-2", "four", "1.5", ""])
+    def test_invalid_env_override(self, monkeypatch, torch, value):
+        """Test that an invalid UPSCALER_THREADS fails with a clear message."""
+        monkeypatch.setenv("UPSCALER_THREADS", value)
+        with pytest.raises(RuntimeError, match="UPSCALER_THREADS must be a positive integer"):
+            _configure_cpu_threads()
+        torch.set_num_threads.assert_not_called()
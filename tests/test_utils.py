@@ -2,15 +2,13 @@
 Tests for the utils module.
 """
 
-import sys
-from pathlib import Path
-
-# Add src to path for imports
-sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+import io
+from unittest.mock import patch
 
+import numpy as np
 from PIL import Image
 
-from upscaler.utils import upscale_image
+from upscaler.utils import draft_for_target, prepare_image, upscale_image, upscale_image_batch
 
 
 class TestUpscaleImage:
@@ -50,3 +48,127 @@ class TestUpscaleImage:
 
         # Should be 400x800 (limited by height)
         assert result.size == (400, 800)
+
+    def test_downscale_skips_model(self):
+        """Test that targets smaller than the original are resized without the model."""
+        img = Image.new("RGB", (400, 200), color="red")
+        with patch("upscaler.utils.enhance_batch") as enhance_batch:
+            result = upscale_image(img, 200, 200)
+
+        enhance_batch.assert_not_called()
+        assert result.size == (200, 100)
+
+
+class TestUpscaleImageBatch:
+    """Tests for the upscale_image_batch function."""
+
+    def test_same_sized_images_share_one_model_call(self):
+        """Test that images are grouped by size and returned in input order."""
+        imgs = [
+            Image.new("RGB", (100, 100), color="red"),
+            Image.new("RGB", (50, 100), color="green"),
+            Image.new("RGB", (100, 100), color="blue"),
+            Image.new("RGB", (800, 800), color="white"),
+        ]
+
+        def fake_enhance(arrays, sizes):
+            return [np.full((h, w, 3), a[0, 0], dtype=np.uint8) for a, (w, h) in zip(arrays, sizes)]
+
+        with patch("upscaler.utils.enhance_batch", side_effect=fake_enhance) as enhance_batch:
+            results = upscale_image_batch(imgs, 400, 400)
+
+        # Two same-sized images in one call, the odd size alone, the downscale skipped
+        assert [len(call.args[0]) for call in enhance_batch.call_args_list] == [2, 1]
+        assert [r.size for r in results] == [(400, 400), (200, 400), (400, 400), (400, 400)]
+        assert [r.getpixel((0, 0)) for r in results[:3]] == [(255, 0, 0), (0, 128, 0), (0, 0, 255)]
+
+    def test_large_images_are_not_stacked(self):
+        """Test that same-sized images above the pixel budget get one model call each."""
+        imgs = [Image.new("RGB", (1024, 1024), color="red") for _ in range(3)]
+
+        def fake_enhance(arrays, sizes):
+            return [np.zeros((1, 1, 3), dtype=np.uint8) for _ in arrays]
+
+        with patch("upscaler.utils.enhance_batch", side_effect=fake_enhance) as enhance_batch:
+            upscale_image_batch(imgs, 4096, 4096)
+
+        assert [len(call.args[0]) for call in enhance_batch.call_args_list] == [1, 1, 1]
+
+    def test_groups_are_split_at_the_pixel_budget(self):
+        """Test that a same-sized group is split into stacks that fit MAX_BATCH_PIXELS."""
+        imgs = [Image.new("RGB", (100, 100), color="red") for _ in range(5)]
+
+        def fake_enhance(arrays, sizes):
+            return [np.zeros((1, 1, 3), dtype=np.uint8) for _ in arrays]
+
+        with (
+            patch("upscaler.upscaler.MAX_BATCH_PIXELS", 2 * 100 * 100),
+            patch("upscaler.utils.enhance_batch", side_effect=fake_enhance) as enhance_batch,
+        ):
+            results = upscale_image_batch(imgs, 400, 400)
+
+        assert [len(call.args[0]) for call in enhance_batch.call_args_list] == [2, 2, 1]
+        assert len(results) == 5
+
+
+class TestDraftForTarget:
+    """Tests for the draft_for_target function."""
+
+    def open_jpeg(self, width, height):
+        """Helper to open an encoded JPEG without loading it."""
+        img_bytes = io.BytesIO()
+        Image.new("RGB", (width, height), color="red").save(img_bytes, format="JPEG")
+        img_bytes.seek(0)
+        return Image.open(img_bytes)
+
+    def test_draft_to_model_input_size(self):
+        """Test that large JPEGs are decoded at the scale the model needs."""
+        img = self.open_jpeg(1600, 1600)
+        draft_for_target(img, 2000, 2000)
+
+        # 2000 // 4 + 32 = 532 needed, so libjpeg can decode at 1/2 scale
+        assert img.size == (800, 800)
+
+    def test_draft_to_target_when_downscaling(self):
+        """Test that downscale targets are never drafted below the target size."""
+        img = self.open_jpeg(1600, 1600)
+        draft_for_target(img, 400, 400)
+
+        assert img.size == (400, 400)
+
+    def test_no_draft_when_full_resolution_needed(self):
+        """Test that the image is left alone when no reduced scale is large enough."""
+        img = self.open_jpeg(800, 800)
+        draft_for_target(img, 1600, 1600)
+
+        assert img.size == (800, 800)
+
+    def test_non_jpeg_is_unchanged(self):
+        """Test that non-JPEG images are not affected."""
+        img_bytes = io.BytesIO()
+        Image.new("RGB", (1600, 1600), color="red").save(img_bytes, format="PNG")
+        img_bytes.seek(0)
+        img = Image.open(img_bytes)
+        draft_for_target(img, 400, 400)
+
+        assert img.size == (1600, 1600)
+
+
+class TestPrepareImage:
+    """Tests for the prepare_image function."""
+
+    def test_chunked_conversion_matches_pixels(self):
+        """Test that large images converted in row bands keep every pixel."""
+        pixels = np.random.default_rng(0).integers(0, 256, (1800, 1700, 3), dtype=np.uint8)
+
+        result = prepare_image(Image.fromarray(pixels))
+
+        assert result.shape == (1800, 1700, 3)
+        np.testing.assert_array_equal(result, pixels)
+
+    def test_converts_to_rgb(self):
+        """Test that non-RGB images are converted before wrapping."""
+        result = prepare_image(Image.new("L", (10, 20), color=128))
+
+        assert result.shape == (20, 10, 3)
+        assert (result == 128).all()